@@ -0,0 +1,311 @@
+from app.binance.resample import can_resample, interval_ms, resample
+from app.config import (
+    ARCHIVE_AFTER_DAYS,
+    BASE_INTERVAL,
+    CANDLE_ARCHIVE_DIR,
+    DB_CONFIG,
+    INTERVALS_TO_DELTA,
+)
+from app.types import CandleFrame, from_ms
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+import argparse
+import logging
+import numpy as np
+import os
+import psycopg
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("ms", tz="UTC")),
+        ("open", pa.float64()),
+        ("high", pa.float64()),
+        ("low", pa.float64()),
+        ("close", pa.float64()),
+        ("volume", pa.float64()),
+    ]
+)
+PART_FILE = "part-0.parquet"
+# Several row groups per month file let the time filter skip most of a file
+ROW_GROUP_SIZE = 10_000
+
+
+def month_key(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).strftime("%Y-%m")
+
+
+def month_start(moment: datetime) -> datetime:
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(moment: datetime) -> datetime:
+    start = month_start(moment)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def months_between(start: datetime, end: datetime) -> List[str]:
+    months = []
+    current = month_start(start)
+    while current <= end:
+        months.append(month_key(current))
+        current = next_month(current)
+    return months
+
+
+def partition_dir(symbol: str, interval: str, month: str, root: str) -> str:
+    return os.path.join(root, f"symbol={symbol}", f"interval={interval}", f"month={month}")
+
+
+def _to_table(frame: CandleFrame) -> pa.Table:
+    return pa.table(
+        {
+            "time": pa.array(frame.time, pa.timestamp("ms", tz="UTC")),
+            "open": frame.open,
+            "high": frame.high,
+            "low": frame.low,
+            "close": frame.close,
+            "volume": frame.volume,
+        },
+        schema=SCHEMA,
+    )
+
+
+def _from_table(symbol: str, table: pa.Table) -> CandleFrame:
+    table = table.sort_by("time")
+    return CandleFrame(
+        symbol=symbol,
+        time=table.column("time").cast(pa.int64()).to_numpy(),
+        open=table.column("open").to_numpy(),
+        high=table.column("high").to_numpy(),
+        low=table.column("low").to_numpy(),
+        close=table.column("close").to_numpy(),
+        volume=table.column("volume").to_numpy(),
+    )
+
+
+def write_archive(
+    candles: CandleFrame, interval: str, root: str = CANDLE_ARCHIVE_DIR
+) -> int:
+    """Write candles into their month partitions and return the number of rows written.
+
+    A month already in the archive is merged with the new candles, so archiving
+    the same range twice leaves one copy of every candle.
+    """
+    if not len(candles):
+        return 0
+    months = candles.time.astype("datetime64[ms]").astype("datetime64[M]")
+    starts = np.flatnonzero(np.append(True, months[1:] != months[:-1]))
+    ends = np.append(starts[1:], len(candles))
+    written = 0
+    for first, last in zip(starts, ends):
+        part = candles[first:last]
+        path = partition_dir(candles.symbol, interval, str(months[first]), root)
+        file = os.path.join(path, PART_FILE)
+        if os.path.exists(file):
+            stored = _from_table(candles.symbol, pq.read_table(file, schema=SCHEMA))
+            merged = CandleFrame.concat([stored, part])
+            order = np.argsort(merged.time, kind="stable")
+            merged = merged[order]
+            # On duplicates the newly archived candle wins
+            keep = np.append(merged.time[1:] != merged.time[:-1], True)
+            part = merged[keep]
+        os.makedirs(path, exist_ok=True)
+        tmp = f"{file}.tmp"
+        pq.write_table(_to_table(part), tmp, row_group_size=ROW_GROUP_SIZE)
+        os.replace(tmp, file)
+        written += len(part)
+    return written
+
+
+def read_archive(
+    symbol: str,
+    interval: str,
+    start: datetime,
+    end: datetime,
+    root: str = CANDLE_ARCHIVE_DIR,
+) -> CandleFrame:
+    """Archived candles opened in [start, end], coarser intervals built from base ones.
+
+    Only the month partitions overlapping the range are opened and the time
+    filter is pushed down to the Parquet row group statistics.
+    """
+    if can_resample(interval) and interval != BASE_INTERVAL:
+        base = read_archive(
+            symbol,
+            BASE_INTERVAL,
+            start,
+            end + INTERVALS_TO_DELTA[interval] - INTERVALS_TO_DELTA[BASE_INTERVAL],
+            root,
+        )
+        return resample(base, interval).slice_time(start, end)
+
+    files = [
+        os.path.join(partition_dir(symbol, interval, month, root), PART_FILE)
+        for month in months_between(start, end)
+    ]
+    files = [file for file in files if os.path.exists(file)]
+    if not files:
+        return CandleFrame.empty(symbol)
+    dataset = ds.dataset(files, schema=SCHEMA, format="parquet")
+    table = dataset.to_table(
+        filter=(ds.field("time") >= pa.scalar(start, pa.timestamp("ms", tz="UTC")))
+        & (ds.field("time") <= pa.scalar(end, pa.timestamp("ms", tz="UTC")))
+    )
+    return _from_table(symbol, table)
+
+
+class ParquetSource:
+    """Offline market data from the archive, a drop-in for BinanceClient.klines.
+
+    Pass it as ``client`` to fetch_candles_until_close or fetch_range to replay
+    archived candles with no network or database. Month partitions are read
+    once and kept in memory.
+    """
+
+    def __init__(self, root: str = CANDLE_ARCHIVE_DIR):
+        self.root = root
+        self.requests = 0
+        self._months: Dict[Tuple[str, str, str], CandleFrame] = {}
+
+    async def __aenter__(self) -> "ParquetSource":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        self._months.clear()
+
+    def _month(self, symbol: str, interval: str, month: str) -> CandleFrame:
+        key = (symbol, interval, month)
+        if key not in self._months:
+            start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+            end = next_month(start) - INTERVALS_TO_DELTA[interval]
+            self._months[key] = read_archive(symbol, interval, start, end, self.root)
+        return self._months[key]
+
+    def candles(
+        self, symbol: str, interval: str, start_ms: int, end_ms: int
+    ) -> CandleFrame:
+        parts = [
+            self._month(symbol, interval, month).slice_time(start_ms, end_ms)
+            for month in months_between(from_ms(start_ms), from_ms(end_ms))
+        ]
+        return CandleFrame.concat(parts) if parts else CandleFrame.empty(symbol)
+
+    async def klines(
+        self,
+        symbol: str,
+        interval: str,
+        start_ms: int,
+        end_ms: Optional[int] = None,
+        limit: int = 1000,
+    ) -> List[list]:
+        """Archived candles in the Binance kline row layout."""
+        self.requests += 1
+        if end_ms is None:
+            end_ms = start_ms + interval_ms(interval) * (limit - 1)
+        page = self.candles(symbol, interval, start_ms, end_ms)[:limit]
+        return [
+            [t, o, h, l, c, v]
+            for t, o, h, l, c, v in zip(
+                page.time.tolist(),
+                page.open.tolist(),
+                page.high.tolist(),
+                page.low.tolist(),
+                page.close.tolist(),
+                page.volume.tolist(),
+            )
+        ]
+
+
+def archive_candles(
+    before: datetime,
+    interval: str = BASE_INTERVAL,
+    symbols: Optional[List[str]] = None,
+    root: str = CANDLE_ARCHIVE_DIR,
+    conn=None,
+) -> int:
+    """Move candles of whole months opened before ``before`` from Postgres to Parquet.
+
+    Each month is written to the archive first and only then deleted from the
+    candles table in one transaction, so a crash leaves the candles in both
+    tiers rather than in none. The candle_ranges index keeps covering them.
+    """
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return archive_candles(before, interval, symbols, root, conn)
+    cutoff = month_start(before)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT symbol, min(time) FROM candles
+            WHERE interval = %s AND time < %s
+                AND (%s::text[] IS NULL OR symbol = ANY(%s::text[]))
+            GROUP BY symbol ORDER BY symbol""",
+            (interval, cutoff, symbols, symbols),
+        )
+        oldest = cur.fetchall()
+
+    moved = 0
+    for symbol, first in oldest:
+        month = month_start(first)
+        while month < cutoff:
+            end = next_month(month)
+            with conn.transaction():
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT time, symbol, open, high, low, close, volume
+                        FROM candles
+                        WHERE symbol = %s AND interval = %s AND time >= %s AND time < %s
+                        ORDER BY time""",
+                        (symbol, interval, month, end),
+                    )
+                    candles = CandleFrame.from_rows(cur.fetchall(), symbol)
+                    if len(candles):
+                        write_archive(candles, interval, root)
+                        cur.execute(
+                            """DELETE FROM candles
+                            WHERE symbol = %s AND interval = %s
+                                AND time >= %s AND time < %s""",
+                            (symbol, interval, month, end),
+                        )
+                        moved += len(candles)
+                        logger.info(
+                            f"Archived {len(candles)} {symbol} {interval} candles "
+                            f"of {month_key(month)}"
+                        )
+            month = end
+    logger.info(f"Archived {moved} candles opened before {cutoff}")
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move old candles from Postgres to the Parquet archive"
+    )
+    parser.add_argument("--interval", default=BASE_INTERVAL, choices=INTERVALS_TO_DELTA.keys())
+    parser.add_argument("--symbols", nargs="*", help="symbols to archive, all by default")
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=ARCHIVE_AFTER_DAYS,
+        help="archive whole months older than this many days",
+    )
+    parser.add_argument("--root", default=CANDLE_ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    before = datetime.now(timezone.utc) - timedelta(days=args.days)
+    archive_candles(before, args.interval, args.symbols, args.root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+from app.binance.archive import ParquetSource
+from app.binance.candles import load_candles
+from app.binance.ranges import Range, merge_ranges
+from app.binance.settlement import first_hits
+from app.config import DB_CONFIG, INTERVALS_TO_DELTA
+from app.types import BacktestResult, CandleFrame, ChannelStats, Signal, to_ms
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+import argparse
+import json
+import logging
+import numpy as np
+import psycopg
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Boolean cells evaluated at once, bounds the memory used by one chunk of signals
+CHUNK_CELLS = 1 << 24
+TRADED = ("tp", "sl", "breakeven", "timeout")
+
+
+def load_signals(
+    channel_ids: Optional[List[int]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    conn=None,
+) -> List[Signal]:
+    """Signals of the given channels, all by default, ordered by signal time."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_signals(channel_ids, since, until, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT * FROM trading_signals
+            WHERE (%s::bigint[] IS NULL OR channel_id = ANY(%s::bigint[]))
+                AND (%s::timestamptz IS NULL OR signal_time >= %s)
+                AND (%s::timestamptz IS NULL OR signal_time <= %s)
+            ORDER BY signal_time""",
+            (channel_ids, channel_ids, since, since, until, until),
+        )
+        return [Signal.from_row(row) for row in cur.fetchall()]
+
+
+def load_frames(
+    sigs: List[Signal],
+    interval: str,
+    max_hold: timedelta,
+    source: Optional[ParquetSource] = None,
+    conn=None,
+) -> Dict[str, CandleFrame]:
+    """Candles covering every signal's holding window, one frame per symbol.
+
+    Overlapping windows of a symbol are merged first so every candle is read
+    once. Candles come from the database unless an offline ``source`` is given.
+    """
+    if conn is None and source is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_frames(sigs, interval, max_hold, source, conn)
+    windows: Dict[str, List[Range]] = {}
+    for sig in sigs:
+        windows.setdefault(sig.symbol, []).append(
+            (sig.signal_time, sig.signal_time + max_hold)
+        )
+    frames: Dict[str, CandleFrame] = {}
+    for symbol, ranges in windows.items():
+        parts = [
+            source.candles(symbol, interval, to_ms(start), to_ms(end))
+            if source is not None
+            else load_candles(symbol, interval, start, end, conn)
+            for start, end in merge_ranges(ranges, INTERVALS_TO_DELTA[interval])
+        ]
+        frames[symbol] = CandleFrame.concat(parts) if parts else CandleFrame.empty(symbol)
+    return frames
+
+
+def _pad(rows: List[List[float]]) -> np.ndarray:
+    width = max((len(row) for row in rows), default=0)
+    padded = np.full((len(rows), max(width, 1)), np.nan)
+    for i, row in enumerate(rows):
+        padded[i, : len(row)] = row
+    return padded
+
+
+def _simulate(
+    frame: CandleFrame,
+    sigs: List[Signal],
+    width: int,
+    hold_ms: int,
+    fee: float,
+    breakeven: bool,
+) -> dict:
+    """Simulate signals of one symbol as a (signals, candles) grid.
+
+    Every signal looks at up to ``width`` candles from its signal time. Entry
+    levels fill when touched, SL/TP hits are searched from the first fill, and
+    when SL and a level are touched by the same candle the SL comes first.
+    """
+    count = len(sigs)
+    rows = np.arange(count)
+    column = np.arange(width)
+    sign = np.array([1.0 if sig.action == "long" else -1.0 for sig in sigs])
+    leverage = np.array([float(sig.leverage or 1) for sig in sigs])
+    start_ms = np.array([to_ms(sig.signal_time) for sig in sigs], dtype=np.int64)
+
+    cols = np.searchsorted(frame.time, start_ms, side="left")[:, None] + column
+    in_frame = cols < len(frame)
+    cols = np.minimum(cols, max(len(frame) - 1, 0))
+    if len(frame):
+        times = frame.time[cols]
+        past_deadline = in_frame & (times > (start_ms + hold_ms)[:, None])
+        inside = in_frame & ~past_deadline
+        deadline_reached = past_deadline.any(axis=1) | inside.all(axis=1)
+        # Shorts are simulated as longs on negated prices
+        low = np.where(sign[:, None] > 0, frame.low[cols], -frame.high[cols])
+        high = np.where(sign[:, None] > 0, frame.high[cols], -frame.low[cols])
+        close = frame.close[cols]
+    else:
+        times = np.zeros((count, width), dtype=np.int64)
+        inside = np.zeros((count, width), dtype=bool)
+        deadline_reached = np.zeros(count, dtype=bool)
+        low = high = close = np.zeros((count, width))
+    low = np.where(inside, low, np.nan)
+    high = np.where(inside, high, np.nan)
+    last = inside.sum(axis=1) - 1
+
+    entries = _pad([sig.entry_prices or [] for sig in sigs])
+    has_entry = ~np.isnan(entries)
+    # Nearest TP first, higher levels in long space are further away
+    tps_long = np.sort(sign[:, None] * _pad([sig.take_profits or [] for sig in sigs]), axis=1)
+    tps = sign[:, None] * tps_long
+    has_tp = ~np.isnan(tps_long)
+    stop_loss = np.array([float(sig.stop_loss) for sig in sigs])
+
+    def never(idx: np.ndarray) -> np.ndarray:
+        return np.where(idx >= 0, idx, width)
+
+    fill_at = never(first_hits(low[:, None, :] <= (sign[:, None] * entries)[:, :, None]))
+    fill_at[~has_entry] = width
+    first_fill = fill_at.min(axis=1)
+    after_fill = column >= first_fill[:, None]
+
+    sl_at = never(first_hits((low <= (sign * stop_loss)[:, None]) & after_fill))
+    # Levels are sorted, so a further TP is never reached before a nearer one
+    tp_at = never(first_hits((high[:, None, :] >= tps_long[:, :, None]) & after_fill[:, None, :]))
+    tp1_at = tp_at[:, 0]
+    sl_first = (sl_at < width) & (sl_at <= tp1_at)
+    tp_first = (tp1_at < width) & ~sl_first
+
+    # The ladder stops filling once the trade reaches SL or its first TP
+    cutoff = np.minimum(np.minimum(sl_at, tp1_at), last)
+    filled = (fill_at < width) & (fill_at <= cutoff[:, None])
+    share = filled / np.maximum(has_entry.sum(axis=1), 1)[:, None]
+    qty = np.divide(share, entries, out=np.zeros_like(share), where=filled)
+    margin = share.sum(axis=1)
+    qty_sum = qty.sum(axis=1)
+    average_entry = np.divide(margin, qty_sum, out=np.zeros_like(margin), where=qty_sum > 0)
+
+    stop_price = stop_loss.copy()
+    stop_at = np.where(sl_first, sl_at, width)
+    if breakeven:
+        after_tp1 = column > tp1_at[:, None]
+        be_at = never(first_hits((low <= (sign * average_entry)[:, None]) & after_tp1))
+        stop_at = np.where(tp_first, be_at, stop_at)
+        stop_price = np.where(tp_first, average_entry, stop_price)
+    else:
+        stop_at = np.where(tp_first, sl_at, stop_at)
+
+    tp_count = has_tp.sum(axis=1)
+    weight = np.divide(1.0, tp_count, out=np.zeros(count), where=tp_count > 0)
+    tp_done = has_tp & (tp_at < stop_at[:, None])
+    tps_hit = tp_done.sum(axis=1)
+    all_tps = (tp_count > 0) & (tps_hit == tp_count)
+    stopped = ~all_tps & (stop_at < width)
+    last_close = close[rows, np.maximum(last, 0)]
+
+    exit_at = np.where(
+        all_tps,
+        np.where(tp_done, tp_at, -1).max(axis=1),
+        np.where(stopped, stop_at, last),
+    )
+    rest = np.where(all_tps, 0.0, 1.0 - tps_hit * weight)
+    rest_price = np.where(stopped, stop_price, last_close)
+    # Margin-weighted sum of exit prices over the partial exits
+    exits = np.where(tp_done, weight[:, None] * tps, 0.0).sum(axis=1) + rest * rest_price
+
+    pnl = 100 * leverage * (
+        sign * (exits * qty_sum - margin) - fee * (margin + exits * qty_sum)
+    )
+
+    traded = first_fill < width
+    outcome = np.where(
+        all_tps,
+        "tp",
+        np.where(
+            stopped,
+            np.where(sl_first | (not breakeven), "sl", "breakeven"),
+            np.where(deadline_reached, "timeout", "open"),
+        ),
+    ).astype(object)
+    outcome[~traded] = np.where(deadline_reached[~traded], "not_filled", "open")
+    return {
+        "entry_time": np.where(traded, times[rows, np.minimum(first_fill, width - 1)], -1),
+        "exit_time": np.where(traded, times[rows, np.maximum(exit_at, 0)], -1),
+        "filled": np.where(traded, margin, 0.0),
+        "tps_hit": np.where(traded, tps_hit, 0),
+        "outcome": outcome,
+        "pnl": np.where(traded, pnl, 0.0),
+    }
+
+
+def backtest(
+    sigs: List[Signal],
+    frames: Dict[str, CandleFrame],
+    interval: str = "5m",
+    max_hold: timedelta = timedelta(days=30),
+    fee: float = 0.0004,
+    breakeven: bool = True,
+) -> BacktestResult:
+    """Simulate signals against their candles with array operations.
+
+    Every signal splits its margin equally over its entry levels and closes an
+    equal share of the filled position at each TP. After the first TP the stop
+    moves to the average entry price when ``breakeven`` is set. ``fee`` is paid
+    on the notional of every fill and exit, and a trade still open after
+    ``max_hold`` is closed at the last candle's close.
+    """
+    sigs = [sig for sig in sigs if sig.action in ("long", "short")]
+    columns: Dict[str, list] = {
+        name: []
+        for name in ("entry_time", "exit_time", "filled", "tps_hit", "outcome", "pnl")
+    }
+    order: List[Signal] = []
+    width = int(max_hold / INTERVALS_TO_DELTA[interval]) + 1
+    hold_ms = int(max_hold.total_seconds() * 1000)
+
+    by_symbol: Dict[str, List[Signal]] = {}
+    for sig in sigs:
+        by_symbol.setdefault(sig.symbol, []).append(sig)
+    for symbol, group in by_symbol.items():
+        frame = frames.get(symbol) or CandleFrame.empty(symbol)
+        levels = max(len(sig.entry_prices or []) + len(sig.take_profits or []) for sig in group)
+        chunk = max(1, CHUNK_CELLS // (width * (levels + 4)))
+        for i in range(0, len(group), chunk):
+            part = _simulate(frame, group[i : i + chunk], width, hold_ms, fee, breakeven)
+            for name, values in part.items():
+                columns[name].append(values)
+        order.extend(group)
+
+    def stack(name: str, dtype) -> np.ndarray:
+        return np.concatenate(columns[name]) if columns[name] else np.empty(0, dtype)
+
+    return BacktestResult(
+        signal_id=np.array([sig.id for sig in order], dtype=np.int64),
+        channel_id=np.array([sig.channel_id for sig in order], dtype=np.int64),
+        entry_time=stack("entry_time", np.int64),
+        exit_time=stack("exit_time", np.int64),
+        filled=stack("filled", np.float64),
+        tps_hit=stack("tps_hit", np.int64),
+        outcome=stack("outcome", object),
+        pnl=stack("pnl", np.float64),
+    )
+
+
+def channel_stats(result: BacktestResult) -> List[ChannelStats]:
+    """Win rate, equity curve and max drawdown of every channel, trades in exit order.
+
+    Equity and drawdown are sums of per-trade PnL, i.e. in percent of the margin
+    of one signal.
+    """
+    traded = np.isin(result.outcome, TRADED)
+    stats = []
+    for channel_id in np.unique(result.channel_id):
+        mask = result.channel_id == channel_id
+        trades = mask & traded
+        order = np.argsort(result.exit_time[trades], kind="stable")
+        pnl = result.pnl[trades][order]
+        equity = np.cumsum(pnl)
+        peak = np.maximum.accumulate(np.append(0.0, equity))[1:]
+        stats.append(
+            ChannelStats(
+                channel_id=int(channel_id),
+                signals=int(mask.sum()),
+                trades=int(trades.sum()),
+                wins=int((pnl > 0).sum()),
+                total_pnl=float(equity[-1]) if len(equity) else 0.0,
+                max_drawdown=float((peak - equity).max()) if len(equity) else 0.0,
+                equity_time=result.exit_time[trades][order],
+                equity=equity,
+            )
+        )
+    return stats
+
+
+def run_backtest(
+    channel_ids: Optional[List[int]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    interval: str = "5m",
+    max_hold: timedelta = timedelta(days=30),
+    fee: float = 0.0004,
+    breakeven: bool = True,
+    source: Optional[ParquetSource] = None,
+) -> BacktestResult:
+    started = time.perf_counter()
+    sigs = load_signals(channel_ids, since, until)
+    frames = load_frames(sigs, interval, max_hold, source)
+    loaded = time.perf_counter()
+    result = backtest(sigs, frames, interval, max_hold, fee, breakeven)
+    logger.info(
+        f"Backtested {len(result)} signals on "
+        f"{sum(len(frame) for frame in frames.values())} candles: "
+        f"loaded in {loaded - started:.1f}s, simulated in {time.perf_counter() - loaded:.1f}s"
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest stored signals by channel")
+    parser.add_argument("--channels", nargs="*", type=int, help="channel ids, all by default")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    parser.add_argument("--interval", default="5m", choices=INTERVALS_TO_DELTA.keys())
+    parser.add_argument("--max-hold-days", type=float, default=30)
+    parser.add_argument("--fee", type=float, default=0.0004, help="fee rate per side")
+    parser.add_argument("--no-breakeven", action="store_true")
+    parser.add_argument("--offline", action="store_true", help="read candles from the archive")
+    parser.add_argument("--output", help="write per-signal and per-channel results as JSON")
+    args = parser.parse_args()
+
+    result = run_backtest(
+        args.channels,
+        args.since,
+        args.until,
+        args.interval,
+        timedelta(days=args.max_hold_days),
+        args.fee,
+        not args.no_breakeven,
+        ParquetSource() if args.offline else None,
+    )
+    stats = channel_stats(result)
+    print(f"{'channel':>16} {'signals':>8} {'trades':>7} {'win rate':>9} {'pnl %':>10} {'max dd %':>9}")
+    for s in sorted(stats, key=lambda s: s.total_pnl, reverse=True):
+        print(
+            f"{s.channel_id:>16} {s.signals:>8} {s.trades:>7} {s.win_rate:>9.1%} "
+            f"{s.total_pnl:>10.2f} {s.max_drawdown:>9.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "generated_at": datetime.now(timezone.utc).isoformat(),
+                    "signals": [
+                        {
+                            "id": int(result.signal_id[i]),
+                            "channel_id": int(result.channel_id[i]),
+                            "entry_time": int(result.entry_time[i]),
+                            "exit_time": int(result.exit_time[i]),
+                            "filled": float(result.filled[i]),
+                            "tps_hit": int(result.tps_hit[i]),
+                            "outcome": result.outcome[i],
+                            "pnl": float(result.pnl[i]),
+                        }
+                        for i in range(len(result))
+                    ],
+                    "channels": [
+                        {
+                            "channel_id": s.channel_id,
+                            "signals": s.signals,
+                            "trades": s.trades,
+                            "win_rate": s.win_rate,
+                            "total_pnl": s.total_pnl,
+                            "max_drawdown": s.max_drawdown,
+                            "equity_time": s.equity_time.tolist(),
+                            "equity": s.equity.tolist(),
+                        }
+                        for s in stats
+                    ],
+                },
+                f,
+            )
+
+
+if __name__ == "__main__":
+    main()
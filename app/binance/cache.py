@@ -0,0 +1,144 @@
+from app.config import KLINE_CACHE_DIR, KLINE_CACHE_MAX_BYTES
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import hashlib
+import logging
+import numpy as np
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# open time, open, high, low, close, volume as float64, open times are exact below 2**53
+KLINE_COLUMNS = 6
+ROW_BYTES = KLINE_COLUMNS * 8
+
+_default: Optional["KlineCache"] = None
+_default_lock = threading.Lock()
+
+
+class KlineCache:
+    """On-disk LRU of closed kline pages with a byte budget.
+
+    Every page is one file of raw float64 rows, the file mtime is its last use
+    so the LRU order survives restarts. Several processes may share the
+    directory: files are replaced atomically and each process evicts by its
+    own view of the directory.
+    """
+
+    def __init__(
+        self, directory: str = KLINE_CACHE_DIR, max_bytes: int = KLINE_CACHE_MAX_BYTES
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".bin"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def key(
+        base_url: str,
+        symbol: str,
+        interval: str,
+        start_ms: int,
+        end_ms: Optional[int],
+        limit: int,
+    ) -> str:
+        # The end time is part of the key, a window cut short by it is another page
+        raw = f"{base_url}|{symbol}|{interval}|{start_ms}|{end_ms}|{limit}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key: str) -> Optional[List[list]]:
+        """Cached kline rows of a page, only the first six columns are kept."""
+        path = self._path(key)
+        try:
+            block = np.fromfile(path, dtype=np.float64)
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self.size -= self._entries.pop(key, 0)
+            return None
+        with self._lock:
+            self.hits += 1
+            if key not in self._entries:
+                self.size += block.nbytes
+            self._entries[key] = block.nbytes
+            self._entries.move_to_end(key)
+        return [
+            [int(row[0]), *row[1:]] for row in block.reshape(-1, KLINE_COLUMNS).tolist()
+        ]
+
+    def put(self, key: str, klines: List[list]) -> None:
+        block = (
+            np.array([k[:KLINE_COLUMNS] for k in klines], dtype=np.float64)
+            if klines
+            else np.empty((0, KLINE_COLUMNS))
+        )
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        block.tofile(tmp)
+        os.replace(tmp, path)
+        with self._lock:
+            self.stores += 1
+            self.size += block.nbytes - self._entries.get(key, 0)
+            self._entries[key] = block.nbytes
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "pages": len(self._entries),
+            "bytes": self.size,
+        }
+
+
+def default_cache() -> Optional[KlineCache]:
+    """Process-wide cache in KLINE_CACHE_DIR, None when the budget is 0."""
+    global _default
+    if KLINE_CACHE_MAX_BYTES <= 0 or not KLINE_CACHE_DIR:
+        return None
+    with _default_lock:
+        if _default is None:
+            _default = KlineCache()
+            logger.info(
+                f"Kline cache in {KLINE_CACHE_DIR}: {len(_default._entries)} pages, "
+                f"{_default.size / 2**20:.1f} of {KLINE_CACHE_MAX_BYTES / 2**20:.0f} MB"
+            )
+        return _default
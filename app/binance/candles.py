@@ -1,16 +1,184 @@
-from app.config import DB_CONFIG
-from app.types import Candle, Signal
+from app.binance.archive import ParquetSource, read_archive
+from app.binance.client import BinanceAPIError, BinanceClient
+from app.binance.ranges import add_range, covering_range, load_ranges
+from app.binance.resample import can_resample, interval_ms, resample
+from app.binance.settlement import settle, settle_signal
+from app.config import (
+    BASE_INTERVAL,
+    DB_CONFIG,
+    FETCH_WINDOWS_IN_FLIGHT,
+    INTERVALS_TO_DELTA,
+    SETTLEMENT_CONCURRENCY,
+)
+from app.types import (
+    Candle,
+    CandleFrame,
+    Settlement,
+    SettlementStats,
+    Signal,
+    from_ms,
+    to_ms,
+)
+from collections import deque
+from contextlib import aclosing
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Literal, Optional, Tuple, Union
-import aiohttp
+from typing import AsyncIterator, Deque, List, Literal, Optional, Tuple, Union
 import asyncio
 import logging
+import numpy as np
 import psycopg
+import time
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+KLINES_PAGE_LIMIT = 1000
+
+
+def page_windows(
+    start_ms: int, end_ms: int, step_ms: int, limit: int = KLINES_PAGE_LIMIT
+) -> List[Tuple[int, int]]:
+    """Split [start_ms, end_ms] into inclusive windows of at most ``limit`` open times."""
+    first = -(-start_ms // step_ms) * step_ms
+    span = step_ms * limit
+    return [
+        (window_start, min(window_start + span - step_ms, end_ms))
+        for window_start in range(first, end_ms + 1, span)
+    ]
+
+
+def _check_window(
+    page: CandleFrame, window: Tuple[int, int], step_ms: int, now_ms: int
+) -> None:
+    window_start, window_end = window
+    if not len(page):
+        return
+    if page.time[0] < window_start or page.time[-1] > window_end:
+        raise BinanceAPIError(200, f"{page.symbol} page outside of {window}")
+    if len(page) > 1 and (np.diff(page.time) <= 0).any():
+        raise BinanceAPIError(200, f"{page.symbol} duplicated candles in {window}")
+    # Only windows that are entirely in the past can be complete
+    last_closed = min(window_end, now_ms - step_ms)
+    expected = (last_closed - window_start) // step_ms + 1
+    if 0 < len(page) < expected:
+        logger.warning(
+            f"{page.symbol}: {expected - len(page)} candles missing in {window}"
+        )
+
+
+async def fetch_range(
+    client: BinanceClient,
+    symbol: str,
+    interval: str,
+    start: datetime,
+    end: Optional[datetime] = None,
+    max_in_flight: int = FETCH_WINDOWS_IN_FLIGHT,
+) -> AsyncIterator[CandleFrame]:
+    """Yield pages of candles opened in [start, end], or up to now without ``end``.
+
+    Page windows are computed up front from the interval length and up to
+    ``max_in_flight`` of them are downloaded concurrently, pages are still
+    yielded in time order so the consumer can stop early.
+    """
+    step_ms = interval_ms(interval)
+    now_ms = to_ms(datetime.now(timezone.utc))
+    end_ms = min(to_ms(end), now_ms) if end is not None else now_ms
+    windows = deque(page_windows(to_ms(start), end_ms, step_ms))
+
+    async def fetch_window(window: Tuple[int, int]) -> CandleFrame:
+        data = await client.klines(
+            symbol, interval, window[0], window[1], KLINES_PAGE_LIMIT
+        )
+        page = CandleFrame.from_klines(symbol, data)
+        _check_window(page, window, step_ms, now_ms)
+        return page
+
+    in_flight: Deque[asyncio.Task] = deque()
+    try:
+        while windows or in_flight:
+            while windows and len(in_flight) < max(1, max_in_flight):
+                in_flight.append(asyncio.create_task(fetch_window(windows.popleft())))
+            page = await in_flight.popleft()
+            if len(page):
+                yield page
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def stream_chunks(
+    client: Union[BinanceClient, ParquetSource],
+    symbol: str,
+    interval: str,
+    start: datetime,
+    end: Optional[datetime] = None,
+) -> AsyncIterator[Tuple[CandleFrame, bool]]:
+    """Yield (page, stored) for candles opened in [start, end], or up to now.
+
+    Ranges already present in the candles table are read from the database in
+    the same page windows as downloads and flagged as stored, only the gaps
+    between them are downloaded from Binance.
+    An offline ParquetSource serves everything itself and the database is not
+    touched.
+    """
+    end = end or datetime.now(timezone.utc)
+    if isinstance(client, ParquetSource):
+        async with aclosing(fetch_range(client, symbol, interval, start, end)) as pages:
+            async for page in pages:
+                yield page, True
+        return
+    stored = await asyncio.to_thread(load_ranges, symbol, interval)
+    step_ms = interval_ms(interval)
+    from_db = fetched = 0
+    current_time = start
+    conn = None
+    try:
+        while current_time <= end:
+            covered = covering_range(stored, current_time)
+            if covered:
+                if conn is None:
+                    conn = await asyncio.to_thread(
+                        psycopg.connect, **DB_CONFIG, autocommit=True
+                    )
+                # Page-sized reads, a long stored range is never loaded at once
+                for window_start, window_end in page_windows(
+                    to_ms(current_time), to_ms(min(covered[1], end)), step_ms
+                ):
+                    page = await asyncio.to_thread(
+                        load_candles,
+                        symbol,
+                        interval,
+                        from_ms(window_start),
+                        from_ms(window_end),
+                        conn,
+                    )
+                    if len(page):
+                        from_db += len(page)
+                        yield page, True
+                current_time = covered[1] + timedelta(milliseconds=1)
+                continue
+
+            next_start = next((s for s, _ in stored if s > current_time), None)
+            gap_end = end
+            if next_start is not None:
+                gap_end = min(end, next_start - timedelta(milliseconds=1))
+            # Closed with this generator, so a stopped stream ends the download too
+            async with aclosing(
+                fetch_range(client, symbol, interval, current_time, gap_end)
+            ) as pages:
+                async for page in pages:
+                    fetched += len(page)
+                    yield page, False
+            current_time = gap_end + timedelta(milliseconds=1)
+    finally:
+        if conn is not None:
+            await asyncio.to_thread(conn.close)
+        logger.info(
+            f"{symbol} {interval}: {from_db} candles read from the database, "
+            f"{fetched} fetched from Binance"
+        )
+
 
 async def fetch_candles_until_close(
     symbol: str,
@@ -19,153 +187,375 @@ async def fetch_candles_until_close(
     stop_loss: float,
     take_profits: List[float],
     post_close_candles: int = 10,
-) -> Tuple[List[Candle], Optional[datetime], Optional[Literal["success", "fail"]]]:
+    client: Optional[Union[BinanceClient, ParquetSource]] = None,
+    action: str = "long",
+    end: Optional[datetime] = None,
+    save: bool = False,
+) -> Tuple[CandleFrame, Optional[datetime], Optional[Literal["success", "fail"]]]:
+    """Collect candles from ``signal_time`` until SL/TP is hit (plus a tail) or ``end``.
+
+    Candles come from stream_chunks, so stored ranges are not downloaded again;
+    with a ParquetSource as ``client`` the signal is replayed offline from the
+    archive. ``end`` defaults to now. Intervals coarser than BASE_INTERVAL are
+    settled on base candles and resampled locally. With ``save`` the pages
+    downloaded from Binance are stored, the ones read back from the database
+    or the archive are not written again.
+    """
     if signal_time.tzinfo is None:
         signal_time = signal_time.replace(tzinfo=timezone.utc)
     else:
         signal_time = signal_time.astimezone(timezone.utc)
 
-    delta = timedelta(minutes=1)
-    candles: List[Candle] = []
-    current_time = signal_time
-    post_close_counter: Optional[int] = None
+    if fetch_interval(interval) != interval:
+        ratio = interval_ms(interval) // interval_ms(BASE_INTERVAL)
+        candles, close_time, result = await fetch_candles_until_close(
+            symbol,
+            signal_time,
+            BASE_INTERVAL,
+            stop_loss,
+            take_profits,
+            post_close_candles * ratio,
+            client=client,
+            action=action,
+            end=end,
+            save=save,
+        )
+        return resample(candles, interval), close_time, result
+
+    parts: List[CandleFrame] = []
+    downloaded: List[CandleFrame] = []
+    # Candles still to collect after the close, None while the signal is open
+    post_close_left: Optional[int] = None
     close_time: Optional[datetime] = None
     result: Optional[Literal["success", "fail"]] = None
 
-    async with aiohttp.ClientSession() as session:
-        while True:
-            start_ms = int(current_time.timestamp() * 1000)
-            url = (
-                f"https://api.binance.com/api/v3/klines"
-                f"?symbol={symbol}&interval={interval}&startTime={start_ms}&limit=1000"
-            )
-
-            async with session.get(url) as response:
-                if response.status != 200:
-                    raise RuntimeError(f"Binance API error: {response.status}")
-                data_from_api = await response.json()
-
-            if not data_from_api:
-                break
-
-            for k in data_from_api:
-                candle = Candle(
-                    time=datetime.fromtimestamp(k[0] / 1000, tz=timezone.utc),
-                    symbol=symbol,
-                    open=float(k[1]),
-                    high=float(k[2]),
-                    low=float(k[3]),
-                    close=float(k[4]),
-                    volume=float(k[5]),
-                )
-
-                candles.append(candle)
+    own_client = client is None
+    if own_client:
+        client = BinanceClient()
 
-                if post_close_counter is not None:
-                    post_close_counter -= 1
-                    if post_close_counter <= 0:
-                        return candles, close_time, result
+    try:
+        async with aclosing(
+            stream_chunks(client, symbol, interval, signal_time, end)
+        ) as chunks:
+            async for page, stored in chunks:
+                if post_close_left is None:
+                    settlement = settle(page, action, stop_loss, take_profits)
+                    if settlement.close_index is not None:
+                        i = settlement.close_index
+                        result = settlement.result
+                        close_time = settlement.close_time
+                        post_close_left = max(post_close_candles, 1)
+                        page = page[: i + 1 + post_close_left]
+                        post_close_left -= len(page) - i - 1
                 else:
-                    if candle.low <= stop_loss:
-                        result = "fail"
-                        close_time = candle.time
-                        post_close_counter = post_close_candles
-                    elif any(candle.high >= tp for tp in take_profits):
-                        result = "success"
-                        close_time = candle.time
-                        post_close_counter = post_close_candles
-
-            last_candle_time = candles[-1].time
-            current_time = last_candle_time + timedelta(milliseconds=1)
-
-            now = datetime.now(timezone.utc)
-            if current_time >= now:
-                logger.info(
-                    f"BREAK: current_time={current_time}, now={now}, candles={len(candles)}"
-                )
-                break
+                    page = page[:post_close_left]
+                    post_close_left -= len(page)
 
-            await asyncio.sleep(0.05)
+                parts.append(page)
+                if not stored:
+                    downloaded.append(page)
+                if post_close_left is not None and post_close_left <= 0:
+                    break
+    finally:
+        if own_client:
+            await client.close()
 
+    if save and downloaded:
+        # Keep the event loop free for the other in-flight signals
+        await asyncio.to_thread(_save_pages, downloaded, interval)
+    candles = CandleFrame.concat(parts) if parts else CandleFrame.empty(symbol)
     return candles, close_time, result
 
 
-def save_candles(candles: List[Candle], interval):
-    if not candles:
-        return
+def _save_pages(pages: List[CandleFrame], interval: str) -> None:
     with psycopg.connect(**DB_CONFIG) as conn:
+        for page in pages:
+            save_candles(page, interval, conn)
+
+
+def fetch_interval(interval: str) -> str:
+    """Interval candles are downloaded and stored in to serve ``interval``."""
+    return BASE_INTERVAL if can_resample(interval) else interval
+
+
+def load_candles(
+    symbol: str, interval: str, start: datetime, end: datetime, conn=None
+) -> CandleFrame:
+    """Stored candles opened in [start, end], coarser intervals built from base ones.
+
+    Months moved to the Parquet archive are read from there and the rest from
+    the candles table, the caller gets one frame either way.
+    """
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_candles(symbol, interval, start, end, conn)
+    if fetch_interval(interval) != interval:
+        base = load_candles(
+            symbol,
+            BASE_INTERVAL,
+            start,
+            end + INTERVALS_TO_DELTA[interval] - INTERVALS_TO_DELTA[BASE_INTERVAL],
+            conn,
+        )
+        return resample(base, interval).slice_time(start, end)
+    cold = read_archive(symbol, interval, start, end)
+    # The archive holds the oldest whole months, Postgres everything after them
+    hot_start = cold.time_at(-1) + INTERVALS_TO_DELTA[interval] if len(cold) else start
+    if hot_start > end:
+        return cold
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT time, symbol, open, high, low, close, volume FROM candles
+            WHERE symbol = %s AND interval = %s AND time >= %s AND time <= %s
+            ORDER BY time""",
+            (symbol, interval, hot_start, end),
+        )
+        hot = CandleFrame.from_rows(cur.fetchall(), symbol)
+    return CandleFrame.concat([cold, hot]) if len(cold) else hot
+
+
+def last_candle_time(symbol: str, interval: str, conn=None) -> Optional[datetime]:
+    """Open time of the newest stored candle ``interval`` candles are built from."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return last_candle_time(symbol, interval, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT max(time) FROM candles WHERE symbol = %s AND interval = %s",
+            (symbol, fetch_interval(interval)),
+        )
+        return cur.fetchone()[0]
+
+
+def save_candles(
+    candles: Union[CandleFrame, List[Candle]], interval, conn=None, closed: bool = False
+) -> int:
+    """Bulk-load candles with COPY and return how many rows were new.
+
+    Rows are streamed into a temporary staging table and merged into candles
+    with one INSERT ... SELECT that skips the (time, symbol) conflicts. Unless
+    the caller knows the candles are ``closed``, the still-forming one is dropped.
+    Each run of consecutive candles is recorded as a stored range.
+    """
+    if not isinstance(candles, CandleFrame):
+        candles = CandleFrame.from_candles(candles)
+    if not closed:
+        # The still-forming candle keeps changing, it is refetched next time
+        candles = candles.slice_time(
+            end=datetime.now(timezone.utc) - INTERVALS_TO_DELTA[interval]
+        )
+    if not len(candles):
+        return 0
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return save_candles(candles, interval, conn, closed=True)
+
+    with conn.transaction():
         with conn.cursor() as cur:
-            cur.executemany(
+            cur.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS candles_staging (
+                    time_ms BIGINT NOT NULL,
+                    open DOUBLE PRECISION,
+                    high DOUBLE PRECISION,
+                    low DOUBLE PRECISION,
+                    close DOUBLE PRECISION,
+                    volume DOUBLE PRECISION
+                ) ON COMMIT DELETE ROWS
+                """
+            )
+            # The connection may already be inside a transaction with staged rows
+            cur.execute("TRUNCATE candles_staging")
+            with cur.copy(
+                """COPY candles_staging (time_ms, open, high, low, close, volume)
+                FROM STDIN (FORMAT BINARY)"""
+            ) as copy:
+                copy.set_types(["int8", "float8", "float8", "float8", "float8", "float8"])
+                for row in zip(
+                    candles.time.tolist(),
+                    candles.open.tolist(),
+                    candles.high.tolist(),
+                    candles.low.tolist(),
+                    candles.close.tolist(),
+                    candles.volume.tolist(),
+                ):
+                    copy.write_row(row)
+            cur.execute(
                 """
                 INSERT INTO candles (time, symbol, open, high, low, close, volume, interval)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                SELECT TIMESTAMPTZ 'epoch' + time_ms * INTERVAL '1 millisecond',
+                    %s, open, high, low, close, volume, %s
+                FROM candles_staging
+                ORDER BY time_ms
                 ON CONFLICT (time, symbol) DO NOTHING
                 """,
-                [
-                    (
-                        c.time,
-                        c.symbol,
-                        c.open,
-                        c.high,
-                        c.low,
-                        c.close,
-                        c.volume,
-                        interval,
-                    )
-                    for c in candles
-                ],
+                (candles.symbol, interval),
             )
-            logger.info(f"Saved {len(candles)} candles for {candles[0].symbol}")
+            inserted = cur.rowcount
+    logger.info(
+        f"Saved {inserted} new of {len(candles)} candles for {candles.symbol}"
+    )
+    # Only contiguous runs are recorded, a gap between pages stays unstored
+    breaks = np.flatnonzero(np.diff(candles.time) != interval_ms(interval)) + 1
+    for start, end in zip([0, *breaks], [*breaks, len(candles)]):
+        add_range(
+            candles.symbol, interval, candles.time_at(start), candles.time_at(end - 1), conn
+        )
+    return inserted
 
 
 def update_closed_signal(
-    signal_id: int, close_time: datetime, result: Literal["success", "fail"], pnl: float
+    signal_id: int,
+    close_time: datetime,
+    result: Literal["success", "fail"],
+    pnl: float,
+    conn=None,
 ):
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE trading_signals SET close_time = %s, result = %s, pnl = %s WHERE id = %s",
-                (close_time, result, pnl, signal_id),
-            )
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return update_closed_signal(signal_id, close_time, result, pnl, conn)
+    with conn.cursor() as cur:
+        # Several settlers may race on one signal, the first close wins
+        cur.execute(
+            """UPDATE trading_signals SET close_time = %s, result = %s, pnl = %s
+            WHERE id = %s AND close_time IS NULL""",
+            (close_time, result, pnl, signal_id),
+        )
+        if cur.rowcount:
             logger.info(f"Updated signal {signal_id} to {close_time=} {result=} {pnl=}")
+        return cur.rowcount > 0
+
+
+def load_open_signals(
+    ids: Optional[List[int]] = None,
+    limit: Optional[int] = None,
+    after_id: int = 0,
+    conn=None,
+) -> List[Signal]:
+    """Signals without close_time ordered by id, optionally only the given ids.
+
+    ``after_id`` together with ``limit`` pages through all open signals.
+    """
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_open_signals(ids, limit, after_id, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT * FROM trading_signals
+            WHERE close_time IS NULL AND id > %s
+                AND (%s::int[] IS NULL OR id = ANY(%s::int[]))
+            ORDER BY id LIMIT %s""",
+            (after_id, ids, ids, limit),
+        )
+        return [Signal.from_row(row) for row in cur.fetchall()]
 
 
 async def process_signal_row(
-    sig: Signal, interval: str = "5m", post_close_intervals: int = 10
-) -> None:
+    sig: Signal,
+    interval: str = "5m",
+    post_close_intervals: int = 10,
+    client: Optional[BinanceClient] = None,
+) -> int:
+    """Settle one signal and return the number of candles fetched for it.
+
+    Candles are stored in the base interval, ``interval`` only sets the length
+    of the tail kept after the close.
+    """
     if not sig.close_time:
+        stored_interval = fetch_interval(interval)
+        ratio = interval_ms(interval) // interval_ms(stored_interval)
         candles, close_time, result = await fetch_candles_until_close(
             sig.symbol,
             sig.signal_time,
-            interval,
+            stored_interval,
             sig.stop_loss,
             sig.take_profits,
-            post_close_intervals,
+            post_close_intervals * ratio,
+            client=client,
+            action=sig.action,
+            save=True,
         )
-        save_candles(candles, interval)
         if close_time and result:
-            pnl = count_pnl(sig, result)
-            update_closed_signal(sig.id, close_time, result, pnl)
+            pnl = count_pnl(sig, result, settle_signal(candles, sig))
+            await asyncio.to_thread(update_closed_signal, sig.id, close_time, result, pnl)
             logger.info(f"Signal {sig.id} closed at {close_time}")
         else:
             logger.info(f"Signal {sig.id} did not hit SL or TP")
+        return len(candles)
     else:
         logger.info(f"🩷 Signal {sig.id} uses cached candles")
+        return 0
 
 
-async def process_signals(sigs: List[Signal], interval="5m", post_close_intervals=7):
-    for signal in sigs:
-        await process_signal_row(
-            signal, interval=interval, post_close_intervals=post_close_intervals
-        )
+async def process_signals(
+    sigs: List[Signal],
+    interval="5m",
+    post_close_intervals=7,
+    concurrency: int = SETTLEMENT_CONCURRENCY,
+    client: Optional[BinanceClient] = None,
+) -> SettlementStats:
+    """Settle signals concurrently over one pooled Binance client.
+
+    At most ``concurrency`` signals are in flight at once. A failing signal is
+    logged and counted, the rest of the batch keeps going. Without ``client``
+    one is opened for the batch.
+    """
+    stats = SettlementStats()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    started = time.perf_counter()
+
+    async def run(client: BinanceClient, sig: Signal) -> None:
+        async with semaphore:
+            try:
+                stats.candles += await process_signal_row(
+                    sig,
+                    interval=interval,
+                    post_close_intervals=post_close_intervals,
+                    client=client,
+                )
+            except Exception as e:
+                stats.failed += 1
+                logger.error(f"Signal {sig.id} ({sig.symbol}) failed to settle: {e}")
+            stats.signals += 1
+
+    if client is not None:
+        await asyncio.gather(*(run(client, sig) for sig in sigs))
+    else:
+        async with BinanceClient(connections=max(1, concurrency)) as client:
+            await asyncio.gather(*(run(client, sig) for sig in sigs))
+
+    stats.elapsed = time.perf_counter() - started
+    logger.info(
+        f"Settled {stats.signals} signals ({stats.failed} failed), "
+        f"{stats.candles} candles in {stats.elapsed:.1f}s: "
+        f"{stats.signals_per_sec:.2f} signals/s, {stats.candles_per_sec:.1f} candles/s"
+    )
+    return stats
+
 
+def count_pnl(
+    sig: Signal,
+    result: Literal["success", "fail"],
+    settlement: Optional[Settlement] = None,
+) -> float:
+    """PnL in percent of margin, exiting at the SL or at the reached TP.
 
-def count_pnl(sig: Signal, result: Literal["success", "fail"]) -> float:
+    With a ``settlement`` the exit is the furthest TP level reached by the
+    closing candle, otherwise the first TP.
+    """
     if sig.action not in ("long", "short"):
         raise ValueError(f"Invalid signal: '{sig}'")
 
     if result == "success":
         target_price = sig.take_profits[0]
+        if settlement is not None and settlement.close_time is not None:
+            reached = [
+                tp
+                for tp, tp_time in zip(sig.take_profits, settlement.tp_times)
+                if tp_time == settlement.close_time
+            ]
+            if reached:
+                target_price = max(reached) if sig.action == "long" else min(reached)
     else:
         target_price = sig.stop_loss
 
@@ -0,0 +1,213 @@
+from app.binance.cache import KlineCache, default_cache
+from app.binance.resample import interval_ms
+from app.config import BINANCE_API_URL, BINANCE_WEIGHT_LIMITS, INTERVALS_TO_DELTA
+from typing import Any, Dict, List, Optional
+import aiohttp
+import asyncio
+import logging
+import random
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-"
+KLINES_WEIGHT = 2
+RETRY_STATUSES = {429, 418}
+# A just closed candle may still be settling on Binance's side
+CLOSE_GRACE_MS = 5_000
+_WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class BinanceAPIError(RuntimeError):
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(f"Binance API error: {status} {message}".strip())
+        self.status = status
+
+
+def window_seconds(window: str) -> int:
+    """Length of a rate limit window given as in the headers, e.g. '1m' or '10s'."""
+    match = re.fullmatch(r"(\d+)([smhd])", window.lower())
+    if not match:
+        raise ValueError(f"Unknown rate limit window: '{window}'")
+    return int(match.group(1)) * _WINDOW_UNITS[match.group(2)]
+
+
+class WeightLimiter:
+    """Token bucket of request weight, corrected by the server-reported usage."""
+
+    def __init__(self, capacity: int, window: float):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, weight: int) -> None:
+        # The lock keeps waiters in FIFO order so big requests are not starved
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= weight:
+                        self.tokens -= weight
+                        return
+                    wait = (weight - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+
+    def sync(self, used_weight: int) -> None:
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, float(self.capacity - used_weight))
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class BinanceClient:
+    """Binance REST client that paces itself by request weight.
+
+    Every request first takes its weight from a token bucket per rate limit
+    window. The buckets follow the ``X-MBX-USED-WEIGHT-*`` headers, 429/418
+    answers block them for ``Retry-After`` seconds, and network errors or 5xx
+    answers are retried with jittered exponential backoff. Kline pages whose
+    candles are all closed are served from ``cache``, the shared on-disk cache
+    unless another one is given or ``use_cache`` is off.
+    """
+
+    def __init__(
+        self,
+        session: Optional[aiohttp.ClientSession] = None,
+        base_url: str = BINANCE_API_URL,
+        weight_limits: Optional[Dict[str, int]] = None,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_cap: float = 30.0,
+        connections: int = 10,
+        cache: Optional[KlineCache] = None,
+        use_cache: bool = True,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limiters = {
+            window.lower(): WeightLimiter(capacity, window_seconds(window))
+            for window, capacity in (weight_limits or BINANCE_WEIGHT_LIMITS).items()
+        }
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.connections = connections
+        self.requests = 0
+        self.cache = (cache or default_cache()) if use_cache else None
+        self._session = session
+        self._own_session = session is None
+
+    async def __aenter__(self) -> "BinanceClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._own_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections)
+            )
+        return self._session
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+
+    def _sync_weights(self, headers) -> None:
+        for name, value in headers.items():
+            if not name.upper().startswith(USED_WEIGHT_HEADER):
+                continue
+            limiter = self.limiters.get(name[len(USED_WEIGHT_HEADER) :].lower())
+            if limiter is not None:
+                limiter.sync(int(value))
+
+    async def get(self, path: str, params: Dict[str, Any], weight: int = 1) -> Any:
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            for limiter in self.limiters.values():
+                await limiter.acquire(weight)
+            self.requests += 1
+            try:
+                async with self._get_session().get(url, params=params) as response:
+                    self._sync_weights(response.headers)
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status in RETRY_STATUSES:
+                        retry_after = float(response.headers.get("Retry-After", 60))
+                        logger.warning(
+                            f"Binance rate limit {response.status}, pausing for {retry_after}s"
+                        )
+                        for limiter in self.limiters.values():
+                            limiter.block(retry_after)
+                        error = BinanceAPIError(response.status, await response.text())
+                    elif response.status >= 500:
+                        error = BinanceAPIError(response.status, await response.text())
+                        await asyncio.sleep(self._backoff(attempt))
+                    else:
+                        raise BinanceAPIError(response.status, await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                await asyncio.sleep(self._backoff(attempt))
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            logger.info(f"Retrying {path} {params} ({attempt}/{self.max_retries}): {error}")
+
+    @staticmethod
+    def _closed_page(
+        interval: str, start_ms: int, end_ms: Optional[int], limit: int
+    ) -> bool:
+        """Whether every candle a klines request can return has already closed."""
+        if interval not in INTERVALS_TO_DELTA:
+            return False
+        step_ms = interval_ms(interval)
+        last_open = -(-start_ms // step_ms) * step_ms + step_ms * (limit - 1)
+        if end_ms is not None:
+            last_open = min(last_open, end_ms)
+        return last_open + step_ms + CLOSE_GRACE_MS <= time.time() * 1000
+
+    async def klines(
+        self,
+        symbol: str,
+        interval: str,
+        start_ms: int,
+        end_ms: Optional[int] = None,
+        limit: int = 1000,
+    ) -> List[list]:
+        key = None
+        if self.cache is not None and self._closed_page(interval, start_ms, end_ms, limit):
+            key = KlineCache.key(self.base_url, symbol, interval, start_ms, end_ms, limit)
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached
+
+        params: Dict[str, Any] = {
+            "symbol": symbol,
+            "interval": interval,
+            "startTime": start_ms,
+            "limit": limit,
+        }
+        if end_ms is not None:
+            params["endTime"] = end_ms
+        klines = await self.get("/api/v3/klines", params, weight=KLINES_WEIGHT)
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, klines)
+        return klines
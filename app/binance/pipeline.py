@@ -0,0 +1,164 @@
+from app.binance.candles import (
+    count_pnl,
+    save_candles,
+    stream_chunks,
+    update_closed_signal,
+)
+from app.binance.client import BinanceClient
+from app.binance.resample import interval_ms
+from app.binance.settlement import settle_signal
+from app.config import DB_CONFIG, PIPELINE_QUEUE_SIZE
+from app.types import CandleFrame, Settlement, Signal, to_ms
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from datetime import timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import logging
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+# Plotting or other read-side stage fed with every page in order
+Consumer = Callable[[CandleFrame], Awaitable[None]]
+
+
+@dataclass
+class Chunk:
+    candles: CandleFrame
+    # Read from the candles table, nothing to write back
+    stored: bool
+    # Signals closed by a candle of this chunk
+    closed: List[Tuple[Signal, Settlement]] = field(default_factory=list)
+
+
+async def _run_stages(*stages: Awaitable[None]) -> None:
+    """Run stages together, a failing stage cancels the others."""
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_pipeline(
+    client: BinanceClient,
+    symbol: str,
+    interval: str,
+    signals: List[Signal],
+    post_close_candles: int = 10,
+    consumers: Sequence[Consumer] = (),
+    persist: bool = True,
+    queue_size: int = PIPELINE_QUEUE_SIZE,
+) -> Tuple[Dict[int, Settlement], int]:
+    """Stream the candles of one symbol's signals through settle, save and consumer stages.
+
+    Pages from stream_chunks go through bounded queues, so only a few pages
+    are in memory however long the range is. The settle stage checks every
+    still open signal on each page and stops the stream once all of them
+    closed and ``post_close_candles`` followed the last close. The save stage
+    commits every page with the signals it closed, so a failure later on keeps
+    what was done so far. ``consumers`` see the same pages in order. Returns
+    the closed settlements by signal id and the number of candles streamed.
+    """
+    start = min(sig.signal_time for sig in signals)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    else:
+        start = start.astimezone(timezone.utc)
+    tail_ms = max(post_close_candles, 1) * interval_ms(interval)
+    pending = {sig.id: sig for sig in signals}
+    settlements: Dict[int, Settlement] = {}
+    settle_queue: asyncio.Queue = asyncio.Queue(queue_size)
+    outputs: List[asyncio.Queue] = [
+        asyncio.Queue(queue_size) for _ in range(len(consumers) + int(persist))
+    ]
+    done = asyncio.Event()
+    streamed = 0
+
+    async def produce() -> None:
+        try:
+            async with aclosing(stream_chunks(client, symbol, interval, start)) as chunks:
+                async for page, stored in chunks:
+                    await settle_queue.put(Chunk(page, stored))
+            await settle_queue.put(None)
+        except asyncio.CancelledError:
+            # Stopped by the settle stage once everything is closed
+            if not done.is_set():
+                raise
+
+    async def settle_stage() -> None:
+        nonlocal streamed
+        stop_after_ms: Optional[int] = None
+        while True:
+            chunk = await settle_queue.get()
+            if chunk is None:
+                break
+            page = chunk.candles
+            for sig in list(pending.values()):
+                try:
+                    settlement = settle_signal(page, sig)
+                except ValueError as e:
+                    # One bad signal is dropped, the others of the symbol go on
+                    logger.error(f"Signal {sig.id} cannot be settled: {e}")
+                    del pending[sig.id]
+                    continue
+                if settlement.closed:
+                    settlements[sig.id] = settlement
+                    chunk.closed.append((sig, settlement))
+                    del pending[sig.id]
+                    close_ms = to_ms(settlement.close_time) + tail_ms
+                    stop_after_ms = max(stop_after_ms or close_ms, close_ms)
+            if not pending and stop_after_ms is not None:
+                page = page.slice_time(end=stop_after_ms)
+                if not len(page) or page.time[-1] >= stop_after_ms:
+                    done.set()
+            chunk.candles = page
+            streamed += len(page)
+            for queue in outputs:
+                await queue.put(chunk)
+            if done.is_set():
+                break
+        done.set()
+        producer.cancel()
+        for queue in outputs:
+            await queue.put(None)
+
+    async def save_stage(queue: asyncio.Queue) -> None:
+        conn = None
+        try:
+            while (chunk := await queue.get()) is not None:
+                if chunk.stored and not chunk.closed:
+                    continue
+                if conn is None:
+                    conn = await asyncio.to_thread(psycopg.connect, **DB_CONFIG)
+                await asyncio.to_thread(_commit_chunk, chunk, interval, conn)
+        finally:
+            if conn is not None:
+                await asyncio.to_thread(conn.close)
+
+    async def consume_stage(queue: asyncio.Queue, consumer: Consumer) -> None:
+        while (chunk := await queue.get()) is not None:
+            await consumer(chunk.candles)
+
+    producer = asyncio.ensure_future(produce())
+    stages = [producer, settle_stage()]
+    if persist:
+        stages.append(save_stage(outputs[-1]))
+    stages.extend(
+        consume_stage(queue, consumer) for queue, consumer in zip(outputs, consumers)
+    )
+    await _run_stages(*stages)
+    return settlements, streamed
+
+
+def _commit_chunk(chunk: Chunk, interval: str, conn) -> None:
+    """Save a chunk's new candles, then close the signals settled on them."""
+    if not chunk.stored:
+        save_candles(chunk.candles, interval, conn)
+    for sig, settlement in chunk.closed:
+        pnl = count_pnl(sig, settlement.result, settlement)
+        update_closed_signal(sig.id, settlement.close_time, settlement.result, pnl, conn)
+    conn.commit()
@@ -0,0 +1,107 @@
+from app.binance.candles import count_pnl, fetch_interval, update_closed_signal
+from app.binance.client import BinanceClient
+from app.binance.pipeline import run_pipeline
+from app.binance.resample import interval_ms
+from app.binance.search import search_group
+from app.config import DB_CONFIG, SETTLEMENT_CONCURRENCY
+from app.types import Settlement, SettlementStats, Signal
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+import psycopg
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def plan_batches(sigs: List[Signal], interval: str) -> Dict[Tuple[str, str], List[Signal]]:
+    """Group open signals by the (symbol, stored interval) their candles come from.
+
+    Signals with an action other than long or short are logged and left out,
+    so they do not fail their whole group.
+    """
+    groups: Dict[Tuple[str, str], List[Signal]] = {}
+    for sig in sigs:
+        if sig.close_time:
+            continue
+        if sig.action not in ("long", "short"):
+            logger.error(f"Signal {sig.id} has an invalid action: '{sig.action}'")
+        else:
+            groups.setdefault((sig.symbol, fetch_interval(interval)), []).append(sig)
+    return groups
+
+
+async def settle_batch(
+    sigs: List[Signal],
+    interval: str = "5m",
+    post_close_intervals: int = 7,
+    concurrency: int = SETTLEMENT_CONCURRENCY,
+    client: Optional[BinanceClient] = None,
+    search: bool = False,
+    horizon: Optional[timedelta] = None,
+) -> SettlementStats:
+    """Settle signals grouped by symbol, one download per group.
+
+    Writes the same close_time/result/pnl as process_signals, but overlapping
+    signals on one pair share their candles, which go through the candle
+    pipeline and are committed page by page. With ``search`` the closes are
+    found by search_close within ``horizon`` and no candles are stored. A
+    failing group is logged and counted, the other groups keep going.
+    """
+    stats = SettlementStats()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    started = time.perf_counter()
+    groups = plan_batches(sigs, interval)
+    # The open signals plan_batches left out for an invalid action
+    stats.failed = sum(not sig.close_time for sig in sigs) - sum(map(len, groups.values()))
+    stats.signals = stats.failed
+
+    async def run(client: BinanceClient, symbol: str, stored_interval: str, group):
+        ratio = interval_ms(interval) // interval_ms(stored_interval)
+        async with semaphore:
+            try:
+                if search:
+                    settlements = await search_group(
+                        client, group, stored_interval, horizon
+                    )
+                    await asyncio.to_thread(_close_signals, group, settlements)
+                else:
+                    settlements, streamed = await run_pipeline(
+                        client, symbol, stored_interval, group, post_close_intervals * ratio
+                    )
+                    stats.candles += streamed
+                for sig in group:
+                    if sig.id not in settlements:
+                        logger.info(f"Signal {sig.id} did not hit SL or TP")
+            except Exception as e:
+                stats.failed += len(group)
+                logger.error(f"Signals of {symbol} failed to settle: {e}")
+            stats.signals += len(group)
+
+    if client is not None:
+        await asyncio.gather(*(run(client, *key, group) for key, group in groups.items()))
+    else:
+        async with BinanceClient(connections=max(1, concurrency)) as client:
+            await asyncio.gather(
+                *(run(client, *key, group) for key, group in groups.items())
+            )
+
+    stats.elapsed = time.perf_counter() - started
+    logger.info(
+        f"Settled {stats.signals} signals in {len(groups)} symbol groups "
+        f"({stats.failed} failed), {stats.candles} candles in {stats.elapsed:.1f}s: "
+        f"{stats.signals_per_sec:.2f} signals/s, {stats.candles_per_sec:.1f} candles/s"
+    )
+    return stats
+
+
+def _close_signals(group: List[Signal], settlements: Dict[int, Settlement]) -> None:
+    with psycopg.connect(**DB_CONFIG) as conn:
+        for sig in group:
+            settlement = settlements.get(sig.id)
+            if settlement is not None:
+                pnl = count_pnl(sig, settlement.result, settlement)
+                update_closed_signal(
+                    sig.id, settlement.close_time, settlement.result, pnl, conn
+                )
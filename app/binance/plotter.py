@@ -1,78 +1,57 @@
 from datetime import datetime
 import logging
-from app.types import Candle
+from app.binance.resample import downsample
+from app.binance.settlement import first_hits
+from app.config import PLOT_MAX_POINTS
+from app.types import Candle, CandleFrame, Settlement
 from plotly.subplots import make_subplots
-from typing import Any, Dict, List
+from typing import List, Optional, Sequence, Tuple, Union
+import numpy as np
 import plotly.graph_objects as go
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def find_price_cross(
-    candles: List[Candle],
+def find_crossings(
+    candles: CandleFrame,
     signal_time: datetime,
-    target_price: float,
-    level_type: str,
-) -> tuple:
-    try:
-        signal_idx = None
-        for i, candle in enumerate(candles):
-            if candle.time >= signal_time:
-                signal_idx = i
-                break
-
-        if signal_idx is None:
-            return None, None, None
-
-        for i in range(signal_idx, len(candles)):
-            candle = candles[i]
-
-            if level_type == "TP":
-                if candle.high >= target_price:
-                    return candle.time, target_price, "Take-Profit"
-
-            elif level_type == "SL":
-                if candle.low <= target_price:
-                    return candle.time, target_price, "Stop-Loss"
-
-            if i < len(candles) - 1:
-                next_candle = candles[i + 1]
-
-                if level_type == "TP":
-                    if candle.close < target_price < next_candle.open:
-                        return next_candle.time, target_price, "Take-Profit"
-
-                elif level_type == "SL":
-                    if candle.close > target_price > next_candle.open:
-                        return next_candle.time, target_price, "Stop-Loss"
-
-        return None, None, None
-
-    except Exception as e:
-        logging.error(f"Error in find_price_cross: {str(e)}", exc_info=True)
-        return None, None, None
-
-
-def find_crossings(candles, target_price, level_type, signal_time):
-    crossings = []
-    signal_passed = False
-
-    for i, candle in enumerate(candles):
-        if candle.time >= signal_time:
-            signal_passed = True
-
-        if signal_passed:
-            if level_type == "TP" and candle.high >= target_price:
-                crossings.append((candle.time, target_price, "TP"))
-            elif level_type == "SL" and candle.low <= target_price:
-                crossings.append((candle.time, target_price, "SL"))
-
-    return crossings[0] if crossings else (None, None, None)
+    stop_loss: Optional[float],
+    take_profits: Sequence[float],
+    action: str = "long",
+) -> Tuple[Optional[datetime], List[Optional[datetime]]]:
+    """Open times of the first candles from ``signal_time`` on crossing the SL and each TP.
+
+    All levels are checked in one pass over the candles. A level also counts as
+    crossed when the price gaps through it between a close and the next open,
+    the crossing is then the candle after the gap.
+    """
+    if action not in ("long", "short"):
+        raise ValueError(f"Invalid action: '{action}'")
+    frame = candles[candles.index_of(signal_time) :]
+    levels = np.array([stop_loss or np.nan, *take_profits], dtype=np.float64).reshape(-1, 1)
+    # TPs are above the entry of a long and below the entry of a short, the SL opposite
+    upward = np.ones_like(levels, dtype=bool)
+    upward[0] = False
+    if action == "short":
+        upward = ~upward
+
+    touched = np.where(upward, frame.high >= levels, frame.low <= levels)
+    gapped = np.zeros_like(touched)
+    prev_close, next_open = frame.close[:-1], frame.open[1:]
+    gapped[:, 1:] = np.where(
+        upward,
+        (prev_close < levels) & (next_open > levels),
+        (prev_close > levels) & (next_open < levels),
+    )
+    times = [
+        frame.time_at(int(i)) if i >= 0 else None for i in first_hits(touched | gapped)
+    ]
+    return times[0], times[1:]
 
 
-def plot_candles_html(
-    candles: List[Candle],
+def build_figure(
+    candles: Union[CandleFrame, List[Candle]],
     symbol: str,
     signal_time: datetime,
     entry_prices: List[float],
@@ -80,23 +59,39 @@ def plot_candles_html(
     take_profits: List[float],
     signal_id: int,
     auto_open: bool = False,
-) -> str:
-    if not candles:
-        return "⚠️ No data for chart"
+    settlement: Optional[Settlement] = None,
+    action: str = "long",
+    max_points: int = PLOT_MAX_POINTS,
+) -> Optional[go.Figure]:
+    """Candlestick and volume figure of a signal with its levels and hits, None without candles."""
+    if not isinstance(candles, CandleFrame):
+        candles = CandleFrame.from_candles(candles)
+    if not len(candles):
+        return None
+
+    if settlement is not None:
+        sl_time, tp_times = settlement.sl_time, settlement.tp_times
+    else:
+        sl_time, tp_times = find_crossings(
+            candles, signal_time, stop_loss, take_profits or [], action
+        )
+    # Long ranges are drawn in coarser candles, except around the marked events
+    events = [t for t in [sl_time, *tp_times] if t is not None]
+    candles = downsample(candles, max_points, [signal_time, *events])
 
     fig = make_subplots(
         rows=2, cols=1, shared_xaxes=True, row_heights=[0.7, 0.3], vertical_spacing=0.03
     )
 
-    times = [c.time for c in candles]
+    times = candles.datetimes()
 
     fig.add_trace(
         go.Candlestick(
             x=times,
-            open=[c.open for c in candles],
-            high=[c.high for c in candles],
-            low=[c.low for c in candles],
-            close=[c.close for c in candles],
+            open=candles.open,
+            high=candles.high,
+            low=candles.low,
+            close=candles.close,
             name="Price",
             increasing_line_color="#06d6a0",
             decreasing_line_color="#f07167",
@@ -110,7 +105,7 @@ def plot_candles_html(
     fig.add_trace(
         go.Bar(
             x=times,
-            y=[c.volume for c in candles],
+            y=candles.volume,
             name="Volume",
             marker_color="#3c096c",
         ),
@@ -120,7 +115,7 @@ def plot_candles_html(
 
     if take_profits:
         for i, tp_price in enumerate(take_profits):
-            tp_time, _, _ = find_crossings(candles, tp_price, "TP", signal_time)
+            tp_time = tp_times[i]
             if tp_time:
                 fig.add_trace(
                     go.Scatter(
@@ -145,7 +140,6 @@ def plot_candles_html(
                 )
 
     if stop_loss:
-        sl_time, _, _ = find_crossings(candles, stop_loss, "SL", signal_time)
         if sl_time:
             fig.add_trace(
                 go.Scatter(
@@ -209,7 +203,7 @@ def plot_candles_html(
                 row=1,  # type: ignore
             )
 
-    entry_price = entry_prices[0] if entry_prices else candles[0].close
+    entry_price = entry_prices[0] if entry_prices else float(candles.close[0])
     fig.add_trace(
         go.Scatter(
             x=[signal_time],
@@ -267,4 +261,41 @@ def plot_candles_html(
     fig.update_xaxes(type="date", row=1, col=1)
     fig.update_xaxes(type="date", row=2, col=1)
 
-    return fig.to_html(full_html=False)
+    return fig
+
+
+def plot_candles_html(
+    candles: Union[CandleFrame, List[Candle]],
+    symbol: str,
+    signal_time: datetime,
+    entry_prices: List[float],
+    stop_loss: float,
+    take_profits: List[float],
+    signal_id: int,
+    auto_open: bool = False,
+    settlement: Optional[Settlement] = None,
+    action: str = "long",
+    max_points: int = PLOT_MAX_POINTS,
+    include_plotlyjs: Union[bool, str] = True,
+) -> str:
+    """Chart of build_figure as an HTML fragment.
+
+    ``include_plotlyjs`` is passed to Figure.to_html, the default inlines the
+    whole plotly.js bundle into every fragment.
+    """
+    fig = build_figure(
+        candles,
+        symbol,
+        signal_time,
+        entry_prices,
+        stop_loss,
+        take_profits,
+        signal_id,
+        auto_open,
+        settlement,
+        action,
+        max_points,
+    )
+    if fig is None:
+        return "⚠️ No data for chart"
+    return fig.to_html(full_html=False, include_plotlyjs=include_plotlyjs)
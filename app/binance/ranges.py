@@ -0,0 +1,185 @@
+from app.config import DB_CONFIG, INTERVALS_TO_DELTA
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+import logging
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+# Inclusive (first open time, last open time) of a contiguous run of candles
+Range = Tuple[datetime, datetime]
+
+_table_ready = False
+
+
+def ensure_ranges_table(conn) -> None:
+    global _table_ready
+    if _table_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS candle_ranges (
+                symbol TEXT NOT NULL,
+                interval TEXT NOT NULL,
+                start_time TIMESTAMPTZ NOT NULL,
+                end_time TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (symbol, interval, start_time)
+            )
+            """
+        )
+    conn.commit()
+    _table_ready = True
+
+
+def merge_ranges(ranges: List[Range], step: timedelta) -> List[Range]:
+    """Merge overlapping or adjacent ranges, returning them sorted by start."""
+    merged: List[Range] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + step:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(
+    ranges: List[Range], start: datetime, end: datetime, step: timedelta
+) -> List[Range]:
+    """Return the parts of [start, end] not covered by the sorted ``ranges``."""
+    gaps: List[Range] = []
+    cursor = start
+    for r_start, r_end in ranges:
+        if r_end < cursor:
+            continue
+        if r_start > end:
+            break
+        if r_start > cursor:
+            gaps.append((cursor, r_start - step))
+        cursor = r_end + step
+        if cursor > end:
+            return gaps
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def covering_range(ranges: List[Range], moment: datetime) -> Optional[Range]:
+    for r_start, r_end in ranges:
+        if r_start <= moment <= r_end:
+            return r_start, r_end
+        if r_start > moment:
+            break
+    return None
+
+
+def load_ranges(symbol: str, interval: str, conn=None) -> List[Range]:
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_ranges(symbol, interval, conn)
+    ensure_ranges_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT start_time, end_time FROM candle_ranges
+            WHERE symbol = %s AND interval = %s ORDER BY start_time""",
+            (symbol, interval),
+        )
+        return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+def add_range(
+    symbol: str, interval: str, start: datetime, end: datetime, conn=None
+) -> List[Range]:
+    """Record [start, end] as stored and return the merged index for the symbol."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return add_range(symbol, interval, start, end, conn)
+    ensure_ranges_table(conn)
+    step = INTERVALS_TO_DELTA[interval]
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Serialise concurrent writers of the same (symbol, interval) index
+            cur.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                (f"candle_ranges:{symbol}:{interval}",),
+            )
+            cur.execute(
+                """SELECT start_time, end_time FROM candle_ranges
+                WHERE symbol = %s AND interval = %s""",
+                (symbol, interval),
+            )
+            ranges = [(row[0], row[1]) for row in cur.fetchall()]
+            merged = merge_ranges(ranges + [(start, end)], step)
+            if merged == sorted(ranges):
+                return merged
+            cur.execute(
+                "DELETE FROM candle_ranges WHERE symbol = %s AND interval = %s",
+                (symbol, interval),
+            )
+            cur.executemany(
+                """INSERT INTO candle_ranges (symbol, interval, start_time, end_time)
+                VALUES (%s, %s, %s, %s)""",
+                [(symbol, interval, r_start, r_end) for r_start, r_end in merged],
+            )
+    return merged
+
+
+def rebuild_ranges(symbol: str, interval: str, conn=None) -> List[Range]:
+    """Recompute the index of a symbol from the rows in the candles table."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return rebuild_ranges(symbol, interval, conn)
+    ensure_ranges_table(conn)
+    step = INTERVALS_TO_DELTA[interval]
+    with conn.transaction():
+        with conn.cursor() as cur:
+            # Gaps-and-islands: rows of one contiguous run share time - n * step
+            cur.execute(
+                """
+                SELECT MIN(time), MAX(time) FROM (
+                    SELECT time,
+                        time - ROW_NUMBER() OVER (ORDER BY time) * %s AS grp
+                    FROM candles WHERE symbol = %s AND interval = %s
+                ) runs
+                GROUP BY grp ORDER BY MIN(time)
+                """,
+                (step, symbol, interval),
+            )
+            ranges = [(row[0], row[1]) for row in cur.fetchall()]
+            cur.execute(
+                "DELETE FROM candle_ranges WHERE symbol = %s AND interval = %s",
+                (symbol, interval),
+            )
+            cur.executemany(
+                """INSERT INTO candle_ranges (symbol, interval, start_time, end_time)
+                VALUES (%s, %s, %s, %s)""",
+                [(symbol, interval, r_start, r_end) for r_start, r_end in ranges],
+            )
+    logger.info(f"Rebuilt {len(ranges)} stored ranges for {symbol} {interval}")
+    return ranges
+
+
+def indexed_symbols(interval: str, conn=None) -> List[str]:
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return indexed_symbols(interval, conn)
+    ensure_ranges_table(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT symbol FROM candle_ranges WHERE interval = %s ORDER BY symbol",
+            (interval,),
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+def candle_symbols(interval: str, conn=None) -> List[str]:
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return candle_symbols(interval, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT DISTINCT symbol FROM candles WHERE interval = %s ORDER BY symbol",
+            (interval,),
+        )
+        return [row[0] for row in cur.fetchall()]
@@ -0,0 +1,89 @@
+from app.binance.candles import fetch_range, save_candles
+from app.binance.client import BinanceClient
+from app.binance.ranges import (
+    add_range,
+    candle_symbols,
+    indexed_symbols,
+    load_ranges,
+    missing_ranges,
+    rebuild_ranges,
+)
+from app.config import INTERVALS_TO_DELTA, SETTLEMENT_CONCURRENCY
+from app.types import CandleFrame
+from typing import List, Optional
+import argparse
+import asyncio
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def repair_gaps(
+    interval: str,
+    symbols: Optional[List[str]] = None,
+    concurrency: int = SETTLEMENT_CONCURRENCY,
+) -> int:
+    """Download the holes between stored ranges and return the number of candles fetched."""
+    step = INTERVALS_TO_DELTA[interval]
+    symbols = symbols or await asyncio.to_thread(indexed_symbols, interval)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    fetched = 0
+
+    async def repair_hole(client, symbol, start, end) -> None:
+        nonlocal fetched
+        async with semaphore:
+            try:
+                candles = CandleFrame.concat(
+                    [
+                        page
+                        async for page in fetch_range(
+                            client, symbol, interval, start, end
+                        )
+                    ]
+                )
+                await asyncio.to_thread(save_candles, candles, interval)
+                # Binance may have nothing for the hole (maintenance, delisting),
+                # mark it as checked so it is not requested again
+                await asyncio.to_thread(add_range, symbol, interval, start, end)
+                fetched += len(candles)
+            except Exception as e:
+                logger.error(f"Cannot repair {symbol} {interval} {start}..{end}: {e}")
+
+    holes = []
+    for symbol in symbols:
+        ranges = await asyncio.to_thread(load_ranges, symbol, interval)
+        if len(ranges) < 2:
+            continue
+        for start, end in missing_ranges(ranges, ranges[0][0], ranges[-1][1], step):
+            holes.append((symbol, start, end))
+    logger.info(f"Found {len(holes)} holes in {len(symbols)} symbols ({interval})")
+
+    async with BinanceClient(connections=max(1, concurrency)) as client:
+        await asyncio.gather(
+            *(repair_hole(client, symbol, start, end) for symbol, start, end in holes)
+        )
+
+    logger.info(f"Repaired {len(holes)} holes with {fetched} candles")
+    return fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill holes in stored candle history")
+    parser.add_argument("--interval", default="1m", choices=INTERVALS_TO_DELTA.keys())
+    parser.add_argument("--symbols", nargs="*", help="symbols to repair, all by default")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="recompute the ranges index from the candles table first",
+    )
+    args = parser.parse_args()
+
+    if args.rebuild:
+        for symbol in args.symbols or candle_symbols(args.interval):
+            rebuild_ranges(symbol, args.interval)
+    asyncio.run(repair_gaps(args.interval, args.symbols))
+
+
+if __name__ == "__main__":
+    main()
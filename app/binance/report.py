@@ -0,0 +1,285 @@
+from app.binance.archive import ParquetSource
+from app.binance.backtest import load_frames, load_signals
+from app.binance.plotter import find_crossings
+from app.binance.resample import downsample
+from app.binance.settlement import settle_signal
+from app.config import INTERVALS_TO_DELTA
+from app.types import CandleFrame, Signal, to_ms
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from html import escape
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+from typing import List, Optional, Tuple
+import argparse
+import logging
+import matplotlib.dates as mdates
+import numpy as np
+import os
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+REPORT_FORMATS = ("png", "svg")
+# Candles per static chart, an image is only about this many pixels wide anyway
+REPORT_MAX_POINTS = 800
+# Part of the time to close still drawn after the close
+CLOSE_MARGIN = 0.2
+DAY_MS = 86_400_000
+
+BACKGROUND = "#10002b"
+GRID = "#4e148c"
+TEXT = "#dee2ff"
+UP = "#06d6a0"
+DOWN = "#f07167"
+
+
+def _bars(
+    left: np.ndarray, width: np.ndarray, bottom: np.ndarray, top: np.ndarray
+) -> np.ndarray:
+    """(n, 4, 2) rectangle corners, drawn as one PolyCollection instead of n patches."""
+    right = left + width
+    return np.stack(
+        [
+            np.stack([left, bottom], axis=1),
+            np.stack([left, top], axis=1),
+            np.stack([right, top], axis=1),
+            np.stack([right, bottom], axis=1),
+        ],
+        axis=1,
+    )
+
+
+def _days(ms) -> np.ndarray:
+    # Matplotlib dates are days since 1970-01-01
+    return np.asarray(ms, dtype=np.float64) / DAY_MS
+
+
+def draw_chart(
+    sig: Signal, candles: CandleFrame, path: str, max_points: int = REPORT_MAX_POINTS
+) -> Optional[str]:
+    """Draw one signal like plot_candles_html as a static image, None without candles."""
+    if not len(candles):
+        return None
+    if sig.action in ("long", "short"):
+        settlement = settle_signal(candles, sig)
+        sl_time, tp_times = settlement.sl_time, settlement.tp_times
+    else:
+        sl_time, tp_times = find_crossings(
+            candles, sig.signal_time, sig.stop_loss, sig.take_profits or []
+        )
+    events = [t for t in [sl_time, *tp_times] if t is not None]
+    candles = downsample(candles, max_points, [sig.signal_time, *events])
+
+    left = _days(candles.time)
+    step = np.diff(left).min() if len(left) > 1 else 1 / 1440
+    width = np.diff(left, append=left[-1] + step) * 0.8
+    middle = left + width / 2
+    colors = np.where(candles.close >= candles.open, UP, DOWN)
+
+    fig = Figure(figsize=(16, 9), facecolor=BACKGROUND)
+    price_ax, volume_ax = fig.subplots(
+        2, 1, sharex=True, gridspec_kw=dict(height_ratios=[7, 3], hspace=0.03)
+    )
+    price_ax.vlines(middle, candles.low, candles.high, colors=colors, linewidth=0.6)
+    bottom = np.minimum(candles.open, candles.close)
+    top = np.maximum(candles.open, candles.close)
+    price_ax.add_collection(
+        PolyCollection(_bars(left, width, bottom, top), facecolors=colors, edgecolors="none")
+    )
+    volume_ax.add_collection(
+        PolyCollection(
+            _bars(left, width, np.zeros(len(candles)), candles.volume),
+            facecolors="#3c096c",
+            edgecolors="none",
+        )
+    )
+    volume_ax.set_ylim(0, max(float(candles.volume.max()), 1e-12) * 1.05)
+
+    levels = [(price, f"Entry {i+1}", "#e9c46a") for i, price in enumerate(sig.entry_prices or [])]
+    if sig.stop_loss:
+        levels.append((sig.stop_loss, "Stop Loss", "#e76f51"))
+    levels += [
+        (price, f"Take Profit {i+1}", "#2a9d8f") for i, price in enumerate(sig.take_profits or [])
+    ]
+    for price, label, color in levels:
+        price_ax.axhline(price, color=color, linestyle="--", linewidth=1.5)
+        price_ax.annotate(
+            label,
+            (1.0, price),
+            xycoords=("axes fraction", "data"),
+            xytext=(4, 0),
+            textcoords="offset points",
+            va="center",
+            color=TEXT,
+        )
+
+    for i, tp_time in enumerate(tp_times):
+        if tp_time is not None:
+            price_ax.scatter(
+                _days(to_ms(tp_time)) + step * 0.4,
+                sig.take_profits[i],
+                marker="D",
+                s=90,
+                color="#ff0000",
+                edgecolors="white",
+                zorder=3,
+            )
+    if sl_time is not None:
+        price_ax.scatter(
+            _days(to_ms(sl_time)) + step * 0.4,
+            sig.stop_loss,
+            marker="X",
+            s=110,
+            color="#a1ff0a",
+            edgecolors="white",
+            zorder=3,
+        )
+    entry_price = sig.entry_prices[0] if sig.entry_prices else float(candles.close[0])
+    price_ax.scatter(
+        _days(to_ms(sig.signal_time)),
+        entry_price,
+        s=90,
+        color="#9d4edd",
+        edgecolors="white",
+        zorder=3,
+    )
+
+    for ax in (price_ax, volume_ax):
+        ax.set_facecolor(BACKGROUND)
+        ax.grid(color=GRID, linewidth=0.5)
+        ax.tick_params(colors=TEXT)
+        for spine in ax.spines.values():
+            spine.set_color(GRID)
+    price_ax.autoscale_view()
+    volume_ax.set_xlim(left[0], left[-1] + step)
+    locator = mdates.AutoDateLocator()
+    volume_ax.xaxis.set_major_locator(locator)
+    volume_ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+    price_ax.set_ylabel("Price", color=TEXT)
+    volume_ax.set_ylabel("Volume", color=TEXT)
+    result = f", {sig.result}" if sig.result else ""
+    price_ax.set_title(f"{sig.symbol} (Signal {sig.id}{result})", color=TEXT, family="monospace")
+    fig.subplots_adjust(left=0.06, right=0.9, top=0.95, bottom=0.06)
+    fig.savefig(path, facecolor=BACKGROUND)
+    return path
+
+
+def _draw(job: Tuple[Signal, CandleFrame, str, int]) -> Optional[str]:
+    sig, candles, path, max_points = job
+    try:
+        return draw_chart(sig, candles, path, max_points)
+    except Exception:
+        logger.exception(f"Could not draw signal {sig.id}")
+        return None
+
+
+def chart_window(sig: Signal, max_hold: timedelta) -> Tuple[datetime, datetime]:
+    """Candles drawn for a signal: up to a bit after its close, at most ``max_hold``."""
+    end = sig.signal_time + max_hold
+    if sig.close_time is not None:
+        end = min(end, sig.close_time + (sig.close_time - sig.signal_time) * CLOSE_MARGIN)
+    return sig.signal_time, end
+
+
+def render_report(
+    sigs: List[Signal],
+    output_dir: str,
+    interval: str = "5m",
+    fmt: str = "png",
+    max_hold: timedelta = timedelta(days=30),
+    workers: Optional[int] = None,
+    max_points: int = REPORT_MAX_POINTS,
+    source: Optional[ParquetSource] = None,
+) -> List[Tuple[Signal, Optional[str]]]:
+    """Draw every signal into ``output_dir`` and write an index.html listing them.
+
+    Candles of all signals are loaded at once, one frame per symbol, and the
+    charts are drawn by a pool of ``workers`` processes, every CPU by default.
+    Returns each signal with its image path, None when it had no candles.
+    """
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"Invalid format: '{fmt}'")
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    frames = load_frames(sigs, interval, max_hold, source)
+    jobs = []
+    for sig in sigs:
+        start, end = chart_window(sig, max_hold)
+        candles = frames[sig.symbol].slice_time(start, end)
+        jobs.append((sig, candles, os.path.join(output_dir, f"signal_{sig.id}.{fmt}"), max_points))
+    loaded = time.perf_counter()
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        # A few chunks per worker keeps it busy without one pickle per chart
+        chunksize = max(1, len(jobs) // (workers * 4))
+        paths = list(pool.map(_draw, jobs, chunksize=chunksize))
+    rendered = list(zip(sigs, paths))
+    write_index(rendered, output_dir)
+    logger.info(
+        f"Rendered {sum(p is not None for p in paths)} of {len(sigs)} charts with {workers} "
+        f"workers: loaded in {loaded - started:.1f}s, drawn in {time.perf_counter() - loaded:.1f}s"
+    )
+    return rendered
+
+
+def write_index(rendered: List[Tuple[Signal, Optional[str]]], output_dir: str) -> str:
+    rows = []
+    for sig, path in rendered:
+        image = (
+            f'<a href="{escape(os.path.basename(path))}">'
+            f'<img src="{escape(os.path.basename(path))}" width="480"></a>'
+            if path
+            else "no candles"
+        )
+        pnl = f"{sig.pnl:.2f}" if sig.pnl is not None else ""
+        rows.append(
+            f"<tr><td>{sig.id}</td><td>{sig.channel_id}</td><td>{escape(sig.symbol)}</td>"
+            f"<td>{escape(sig.action or '')}</td><td>{sig.signal_time:%Y-%m-%d %H:%M}</td>"
+            f"<td>{escape(sig.result or '')}</td><td>{pnl}</td><td>{image}</td></tr>"
+        )
+    path = os.path.join(output_dir, "index.html")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            "<!doctype html><meta charset=\"utf-8\"><title>Signals report</title>"
+            f"<p>Generated {datetime.now(timezone.utc):%Y-%m-%d %H:%M} UTC</p>"
+            "<table border=\"1\" cellpadding=\"4\"><tr><th>ID</th><th>Channel</th>"
+            "<th>Symbol</th><th>Action</th><th>Signal time</th><th>Result</th>"
+            "<th>Pnl (for 100$)</th><th>Chart</th></tr>\n"
+            + "\n".join(rows)
+            + "\n</table>\n"
+        )
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render static charts of stored signals")
+    parser.add_argument("--channels", nargs="*", type=int, help="channel ids, all by default")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    parser.add_argument("--interval", default="5m", choices=INTERVALS_TO_DELTA.keys())
+    parser.add_argument("--max-hold-days", type=float, default=30)
+    parser.add_argument("--format", default="png", choices=REPORT_FORMATS)
+    parser.add_argument("--workers", type=int, help="processes, one per CPU by default")
+    parser.add_argument("--max-points", type=int, default=REPORT_MAX_POINTS)
+    parser.add_argument("--offline", action="store_true", help="read candles from the archive")
+    parser.add_argument("--output-dir", default="report")
+    args = parser.parse_args()
+
+    sigs = load_signals(args.channels, args.since, args.until)
+    render_report(
+        sigs,
+        args.output_dir,
+        args.interval,
+        args.format,
+        timedelta(days=args.max_hold_days),
+        args.workers,
+        args.max_points,
+        ParquetSource() if args.offline else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
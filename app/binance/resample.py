@@ -0,0 +1,80 @@
+from app.config import BASE_INTERVAL, INTERVALS_TO_DELTA, PLOT_KEEP_CANDLES
+from app.types import CandleFrame, to_ms
+from datetime import datetime
+from typing import Iterable, Union
+import numpy as np
+
+
+def interval_ms(interval: str) -> int:
+    return int(INTERVALS_TO_DELTA[interval].total_seconds() * 1000)
+
+
+def can_resample(interval: str, base: str = BASE_INTERVAL) -> bool:
+    """Whether ``interval`` is a whole multiple of ``base`` that can be aggregated from it."""
+    if interval not in INTERVALS_TO_DELTA or base not in INTERVALS_TO_DELTA:
+        return False
+    return interval_ms(interval) % interval_ms(base) == 0
+
+
+def aggregate(frame: CandleFrame, starts: np.ndarray) -> CandleFrame:
+    """Merge the runs of candles beginning at ``starts`` into one candle each."""
+    ends = np.append(starts[1:], len(frame)) - 1
+    return CandleFrame(
+        symbol=frame.symbol,
+        time=frame.time[starts],
+        open=frame.open[starts],
+        high=np.maximum.reduceat(frame.high, starts),
+        low=np.minimum.reduceat(frame.low, starts),
+        close=frame.close[ends],
+        volume=np.add.reduceat(frame.volume, starts),
+    )
+
+
+def resample(frame: CandleFrame, interval: str) -> CandleFrame:
+    """Aggregate finer candles into ``interval`` buckets aligned to UTC epoch.
+
+    Buckets take the open of their first candle, the close of their last one,
+    the extreme high/low and the summed volume, and are stamped with the bucket
+    start like Binance klines. Intervals up to 1d are aligned to UTC midnight.
+    """
+    if not len(frame):
+        return frame
+    step = interval_ms(interval)
+    buckets = frame.time // step * step
+    starts = np.flatnonzero(np.append(True, buckets[1:] != buckets[:-1]))
+    resampled = aggregate(frame, starts)
+    resampled.time = buckets[starts]
+    return resampled
+
+
+def downsample(
+    frame: CandleFrame,
+    max_points: int,
+    keep: Iterable[Union[datetime, int]] = (),
+    keep_candles: int = PLOT_KEEP_CANDLES,
+) -> CandleFrame:
+    """Merge runs of candles so that about ``max_points`` are left.
+
+    The ``keep_candles`` candles on each side of every ``keep`` moment stay as
+    they are, so markers placed at those times still sit on their own bar. The
+    rest is split into equal runs of consecutive candles, each becoming one
+    candle stamped with the open time of its first candle.
+    """
+    n = len(frame)
+    if max_points <= 0 or n <= max_points:
+        return frame
+    moments = [to_ms(moment) for moment in keep]
+    kept = np.zeros(n, dtype=bool)
+    if moments:
+        # Full-resolution windows take at most half of the budget
+        half = min(keep_candles, max_points // (4 * len(moments)))
+        for i in np.searchsorted(frame.time, moments, side="left"):
+            kept[max(i - half, 0) : i + half + 1] = True
+
+    free = ~kept
+    run = -(-int(free.sum()) // max(max_points - int(kept.sum()), 1))
+    bucket = np.where(free, (np.cumsum(free) - 1) // run, -1)
+    starts = np.flatnonzero(
+        np.concatenate(([True], kept[1:] | (bucket[1:] != bucket[:-1])))
+    )
+    return aggregate(frame, starts)
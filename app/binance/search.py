@@ -0,0 +1,147 @@
+from app.binance.candles import fetch_range
+from app.binance.client import BinanceClient
+from app.binance.resample import interval_ms
+from app.binance.settlement import level_masks, settle
+from app.config import BASE_INTERVAL, SEARCH_HORIZON_DAYS, SEARCH_LEVELS
+from app.types import Settlement, Signal, from_ms, to_ms
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def default_horizon() -> Optional[timedelta]:
+    return timedelta(days=SEARCH_HORIZON_DAYS) if SEARCH_HORIZON_DAYS > 0 else None
+
+
+def search_levels(interval: str, coarse: Sequence[str] = SEARCH_LEVELS) -> List[str]:
+    """Coarse intervals longer than ``interval``, longest first, then ``interval`` itself."""
+    step = interval_ms(interval)
+    levels = sorted((c for c in coarse if interval_ms(c) > step), key=interval_ms, reverse=True)
+    return levels + [interval]
+
+
+def _coarse_settlement(
+    bar_ms: int, sl_hit: bool, tp_hit: np.ndarray
+) -> Settlement:
+    bar = from_ms(bar_ms)
+    return Settlement(
+        sl_time=bar if sl_hit else None,
+        tp_times=[bar if hit else None for hit in tp_hit],
+        close_time=bar,
+        result="fail" if sl_hit else "success",
+        tps_hit=0 if sl_hit else int(tp_hit.sum()),
+    )
+
+
+async def search_close(
+    symbol: str,
+    signal_time: datetime,
+    stop_loss: float,
+    take_profits: Sequence[float],
+    action: str = "long",
+    client: Optional[BinanceClient] = None,
+    interval: str = BASE_INTERVAL,
+    horizon: Optional[timedelta] = None,
+    exact: bool = True,
+    coarse: Sequence[str] = SEARCH_LEVELS,
+) -> Settlement:
+    """Find where a signal closes by scanning coarse candles first.
+
+    Daily, then hourly bars are scanned for the first one whose range touches
+    the SL or a TP, and only that bar is fetched again in finer candles. With
+    ``exact`` the search always goes down to ``interval`` and gives the same
+    close as settling every ``interval`` candle; without it, it stops at the
+    first bar touched by only one side and reports that bar's open time. The
+    search ends at ``signal_time + horizon`` or now. TP times other than the
+    closing one are not searched.
+    """
+    if signal_time.tzinfo is None:
+        signal_time = signal_time.replace(tzinfo=timezone.utc)
+    now = datetime.now(timezone.utc)
+    end = min(signal_time + horizon, now) if horizon is not None else now
+    stop_loss = float(stop_loss)
+
+    async def first_hit(levels: List[str], start_ms: int, end_ms: int) -> Optional[Settlement]:
+        interval = levels[0]
+        if len(levels) == 1:
+            async with aclosing(
+                fetch_range(client, symbol, interval, from_ms(start_ms), from_ms(end_ms))
+            ) as pages:
+                async for page in pages:
+                    settlement = settle(page, action, stop_loss, take_profits)
+                    if settlement.closed:
+                        return settlement
+            return None
+
+        finer = levels[1:]
+        step = interval_ms(interval)
+        first_bar = -(-start_ms // step) * step
+        # Bars that begin before the signal or end after the horizon hold prices
+        # from outside the range, those parts are searched at the finer level
+        last_bar = (end_ms + 1) // step * step - step
+        if first_bar > start_ms:
+            hit = await first_hit(finer, start_ms, min(first_bar - 1, end_ms))
+            if hit is not None or first_bar > end_ms:
+                return hit
+
+        if last_bar >= first_bar:
+            async with aclosing(
+                fetch_range(client, symbol, interval, from_ms(first_bar), from_ms(last_bar))
+            ) as pages:
+                async for page in pages:
+                    sl_mask, tp_mask = level_masks(page, action, stop_loss, take_profits)
+                    for i in np.flatnonzero(sl_mask | tp_mask.any(axis=0)):
+                        bar_ms = int(page.time[i])
+                        if not exact and sl_mask[i] != tp_mask[:, i].any():
+                            # Only one side was touched, the outcome is known already
+                            return _coarse_settlement(bar_ms, bool(sl_mask[i]), tp_mask[:, i])
+                        hit = await first_hit(finer, bar_ms, bar_ms + step - 1)
+                        if hit is not None:
+                            return hit
+
+        tail_start = max(first_bar, last_bar + step)
+        if tail_start <= end_ms:
+            return await first_hit(finer, tail_start, end_ms)
+        return None
+
+    own_client = client is None
+    if own_client:
+        client = BinanceClient()
+    try:
+        hit = await first_hit(
+            search_levels(interval, coarse), to_ms(signal_time), to_ms(end)
+        )
+    finally:
+        if own_client:
+            await client.close()
+    return hit or Settlement(
+        sl_time=None, tp_times=[None] * len(take_profits), close_time=None, result=None
+    )
+
+
+async def search_group(
+    client: BinanceClient,
+    group: List[Signal],
+    interval: str = BASE_INTERVAL,
+    horizon: Optional[timedelta] = None,
+) -> Dict[int, Settlement]:
+    """Closed settlements of a group of signals found by search_close, by signal id."""
+    settlements: Dict[int, Settlement] = {}
+    for sig in group:
+        settlement = await search_close(
+            sig.symbol,
+            sig.signal_time,
+            sig.stop_loss,
+            sig.take_profits,
+            sig.action,
+            client=client,
+            interval=interval,
+            horizon=horizon,
+        )
+        if settlement.closed:
+            settlements[sig.id] = settlement
+    return settlements
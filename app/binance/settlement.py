@@ -0,0 +1,87 @@
+from app.types import CandleFrame, Settlement, Signal
+from datetime import datetime
+from typing import List, Optional, Sequence, Union
+import numpy as np
+
+
+def first_hits(mask: np.ndarray) -> np.ndarray:
+    """Index of the first True along the last axis, -1 where there is none."""
+    if mask.shape[-1] == 0:
+        return np.full(mask.shape[:-1], -1, dtype=np.int64)
+    return np.where(mask.any(axis=-1), mask.argmax(axis=-1), -1)
+
+
+def level_masks(
+    candles: CandleFrame,
+    action: str,
+    stop_loss: float,
+    take_profits: Sequence[float],
+) -> tuple:
+    """Per-candle touches of the SL and, one row per level, of every TP."""
+    if action not in ("long", "short"):
+        raise ValueError(f"Invalid action: '{action}'")
+
+    levels = np.asarray(take_profits, dtype=np.float64).reshape(-1, 1)
+    if action == "long":
+        return candles.low <= stop_loss, candles.high >= levels
+    return candles.high >= stop_loss, candles.low <= levels
+
+
+def level_hits(
+    candles: CandleFrame,
+    action: str,
+    stop_loss: float,
+    take_profits: Sequence[float],
+) -> tuple:
+    """First-hit candle indices of the SL and of every TP level, -1 if never hit."""
+    sl_mask, tp_mask = level_masks(candles, action, stop_loss, take_profits)
+    return int(first_hits(sl_mask)), first_hits(tp_mask)
+
+
+def settle(
+    candles: CandleFrame,
+    action: str,
+    stop_loss: float,
+    take_profits: Sequence[float],
+    signal_time: Optional[Union[datetime, int]] = None,
+) -> Settlement:
+    """Settle a signal against a whole candle array at once.
+
+    The signal closes on the first candle that reaches the SL or any TP level. When
+    both are reached by the same candle the order inside it is unknown and the SL
+    is assumed to come first. Indices refer to ``candles``.
+    """
+    offset = 0 if signal_time is None else candles.index_of(signal_time)
+    frame = candles[offset:]
+    sl_idx, tp_idx = level_hits(frame, action, float(stop_loss), take_profits)
+
+    first_tp = int(tp_idx[tp_idx >= 0].min()) if (tp_idx >= 0).any() else -1
+    close_idx: Optional[int] = None
+    result = None
+    if sl_idx >= 0 and (first_tp < 0 or sl_idx <= first_tp):
+        close_idx, result = sl_idx, "fail"
+    elif first_tp >= 0:
+        close_idx, result = first_tp, "success"
+
+    # Levels gapped through by the closing candle count as reached together
+    tps_hit = int((tp_idx == close_idx).sum()) if result == "success" else 0
+
+    return Settlement(
+        sl_time=frame.time_at(sl_idx) if sl_idx >= 0 else None,
+        tp_times=[frame.time_at(int(i)) if i >= 0 else None for i in tp_idx],
+        close_time=frame.time_at(close_idx) if close_idx is not None else None,
+        result=result,
+        close_index=offset + close_idx if close_idx is not None else None,
+        tps_hit=tps_hit,
+    )
+
+
+def settle_signal(candles: CandleFrame, sig: Signal) -> Settlement:
+    return settle(
+        candles, sig.action, sig.stop_loss, sig.take_profits, sig.signal_time
+    )
+
+
+def settle_many(candles: CandleFrame, sigs: List[Signal]) -> List[Settlement]:
+    """Settle several signals of one symbol against a shared candle array."""
+    return [settle_signal(candles, sig) for sig in sigs]
@@ -0,0 +1,380 @@
+from app.binance.candles import (
+    count_pnl,
+    fetch_range,
+    load_open_signals,
+    save_candles,
+    update_closed_signal,
+)
+from app.binance.client import BinanceClient
+from app.binance.planner import settle_batch
+from app.binance.resample import interval_ms
+from app.binance.settlement import settle_signal
+from app.config import (
+    BASE_INTERVAL,
+    BINANCE_WS_URL,
+    DB_CONFIG,
+    INTERVALS_TO_DELTA,
+    TRACKER_REFRESH_SECONDS,
+    TRACKER_STREAMS_PER_CONNECTION,
+)
+from app.types import CandleFrame, Signal, from_ms
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set
+import aiohttp
+import asyncio
+import logging
+import numpy as np
+import psycopg
+import random
+import signal
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class StreamConnection:
+    """One WebSocket connection multiplexing the kline streams of several symbols."""
+
+    def __init__(self, tracker: "KlineTracker", index: int):
+        self.tracker = tracker
+        self.index = index
+        self.symbols: Set[str] = set()
+        self.subscribed: Set[str] = set()
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._request_id = 0
+
+    def stream(self, symbol: str) -> str:
+        return f"{symbol.lower()}@kline_{self.tracker.interval}"
+
+    async def sync(self) -> None:
+        """Subscribe to added symbols and unsubscribe from removed ones.
+
+        Candles that closed before a symbol's stream was subscribed, since the
+        signal was loaded or while the connection was down, come from REST.
+        """
+        if self.ws is None or self.ws.closed:
+            return
+        added = self.symbols - self.subscribed
+        removed = self.subscribed - self.symbols
+        for method, symbols in (("SUBSCRIBE", added), ("UNSUBSCRIBE", removed)):
+            if symbols:
+                self._request_id += 1
+                await self.ws.send_json(
+                    {
+                        "method": method,
+                        "params": [self.stream(s) for s in sorted(symbols)],
+                        "id": self._request_id,
+                    }
+                )
+        self.subscribed = set(self.symbols)
+        await self.tracker.backfill(added)
+
+    async def run(self, session: aiohttp.ClientSession, stop: asyncio.Event) -> None:
+        attempt = 0
+        while not stop.is_set():
+            try:
+                async with session.ws_connect(
+                    f"{self.tracker.ws_url}/stream", heartbeat=60
+                ) as ws:
+                    self.ws = ws
+                    self.subscribed = set()
+                    await self.sync()
+                    attempt = 0
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            await self.tracker.handle(msg.json())
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Stream connection {self.index} dropped: {e}")
+            except Exception as e:
+                logger.error(f"Stream connection {self.index} failed: {e}")
+            finally:
+                self.ws = None
+
+            if stop.is_set():
+                break
+            delay = random.uniform(0, min(60, 2**attempt))
+            attempt += 1
+            logger.info(f"Reconnecting stream connection {self.index} in {delay:.1f}s")
+            try:
+                await asyncio.wait_for(stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class KlineTracker:
+    """Follow open signals over Binance kline WebSocket streams.
+
+    New open signals are first brought up to date over REST, then settled from
+    the live kline updates of their symbol: the running high/low of the current
+    candle closes a signal as soon as SL or TP is touched, and every closed
+    candle is appended to the candles table by a writer task in batches, off
+    the WebSocket read loop. Symbols are spread over connections of at most
+    ``streams_per_connection`` streams each.
+    """
+
+    def __init__(
+        self,
+        client: Optional[BinanceClient] = None,
+        ws_url: str = BINANCE_WS_URL,
+        interval: str = BASE_INTERVAL,
+        streams_per_connection: int = TRACKER_STREAMS_PER_CONNECTION,
+        refresh_seconds: float = TRACKER_REFRESH_SECONDS,
+    ):
+        self.client = client
+        self.ws_url = ws_url.rstrip("/")
+        self.interval = interval
+        self.streams_per_connection = streams_per_connection
+        self.refresh_seconds = refresh_seconds
+        self.signals: Dict[str, Dict[int, Signal]] = {}
+        self.last_closed: Dict[str, int] = {}
+        # Open signals left untracked, warned about once
+        self.invalid: Set[int] = set()
+        self.connections: List[StreamConnection] = []
+        self.settled = 0
+        self._tasks: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stop: Optional[asyncio.Event] = None
+        # Closed candles waiting for the writer, a put never blocks the read loop
+        self._closed: asyncio.Queue = asyncio.Queue()
+        self._conn = None
+
+    async def refresh(self) -> None:
+        """Pick up new open signals and forget the ones closed elsewhere."""
+        open_signals = await asyncio.to_thread(load_open_signals)
+        open_ids = {sig.id for sig in open_signals}
+        for symbol in list(self.signals):
+            tracked = self.signals[symbol]
+            for sig_id in [sig_id for sig_id in tracked if sig_id not in open_ids]:
+                del tracked[sig_id]
+            if not tracked:
+                del self.signals[symbol]
+                self.last_closed.pop(symbol, None)
+
+        known = {sig_id for tracked in self.signals.values() for sig_id in tracked}
+        self.invalid &= open_ids
+        known |= self.invalid
+        new = [sig for sig in open_signals if sig.id not in known]
+        # settle_signal raises on them, and the stream would reconnect forever
+        for sig in [sig for sig in new if sig.action not in ("long", "short")]:
+            logger.warning(f"Signal {sig.id} has an invalid action: '{sig.action}'")
+            self.invalid.add(sig.id)
+        new = [sig for sig in new if sig.id not in self.invalid]
+        rewound: Set[str] = set()
+        if new:
+            # The batch settles up to about now, later candles come from a backfill
+            step = interval_ms(self.interval)
+            settled_to = int(datetime.now(timezone.utc).timestamp() * 1000)
+            settled_to = settled_to // step * step - step
+            await settle_batch(new, interval=self.interval, client=self.client)
+            still_open = await asyncio.to_thread(
+                load_open_signals, [sig.id for sig in new]
+            )
+            for sig in still_open:
+                self.signals.setdefault(sig.symbol, {})[sig.id] = sig
+                # A streamed symbol went on while the batch ran, its candles since
+                # are applied again: they did not close its other signals before
+                if self.last_closed.get(sig.symbol, settled_to) > settled_to:
+                    rewound.add(sig.symbol)
+                self.last_closed[sig.symbol] = min(
+                    self.last_closed.get(sig.symbol, settled_to), settled_to
+                )
+            logger.info(
+                f"Tracking {len(still_open)} new open signals, "
+                f"{len(new) - len(still_open)} closed during backfill"
+            )
+        await self.backfill(rewound)
+        await self._assign(set(self.signals))
+
+    async def _assign(self, symbols: Set[str]) -> None:
+        for connection in self.connections:
+            connection.symbols &= symbols
+        assigned = set().union(*(c.symbols for c in self.connections))
+        for symbol in sorted(symbols - assigned):
+            connection = next(
+                (
+                    c
+                    for c in self.connections
+                    if len(c.symbols) < self.streams_per_connection
+                ),
+                None,
+            )
+            if connection is None:
+                connection = StreamConnection(self, len(self.connections))
+                self.connections.append(connection)
+                self._tasks.append(
+                    asyncio.create_task(connection.run(self._session, self._stop))
+                )
+            connection.symbols.add(symbol)
+        for connection in self.connections:
+            await connection.sync()
+
+    async def apply(self, candles: CandleFrame) -> None:
+        """Settle the tracked signals of the candles' symbol that they close."""
+        tracked = self.signals.get(candles.symbol, {})
+        for sig in list(tracked.values()):
+            settlement = settle_signal(candles, sig)
+            # A backfill and the live stream may close the same signal together
+            if not settlement.closed or tracked.pop(sig.id, None) is None:
+                continue
+            pnl = count_pnl(sig, settlement.result, settlement)
+            await asyncio.to_thread(
+                update_closed_signal,
+                sig.id,
+                settlement.close_time,
+                settlement.result,
+                pnl,
+            )
+            self.settled += 1
+            logger.info(
+                f"Signal {sig.id} ({sig.symbol}) closed live at "
+                f"{settlement.close_time}: {settlement.result}"
+            )
+
+    async def handle(self, message: dict) -> None:
+        data = message.get("data", message)
+        if data.get("e") != "kline":
+            return
+        k = data["k"]
+        candle = CandleFrame.from_klines(
+            k["s"], [[k["t"], k["o"], k["h"], k["l"], k["c"], k["v"]]]
+        )
+        await self.apply(candle)
+        if k["x"]:
+            self._closed.put_nowait(candle)
+            self.last_closed[candle.symbol] = max(
+                self.last_closed.get(candle.symbol, 0), int(k["t"])
+            )
+
+    def _save(self, frames: List[CandleFrame]) -> None:
+        # One connection for the writer, opened again after a failure
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg.connect(**DB_CONFIG)
+        by_symbol: Dict[str, List[CandleFrame]] = {}
+        for frame in frames:
+            by_symbol.setdefault(frame.symbol, []).append(frame)
+        for parts in by_symbol.values():
+            candles = CandleFrame.concat(parts)
+            # Live candles and a backfill can overlap, keep each open time once
+            candles = candles[np.unique(candles.time, return_index=True)[1]]
+            save_candles(candles, self.interval, self._conn, closed=True)
+        self._conn.commit()
+
+    async def _writer(self) -> None:
+        """Save closed candles in batches, everything queued since the last write.
+
+        A None in the queue writes what is left and stops the writer.
+        """
+        pending: List[CandleFrame] = []
+        stopping = False
+        while not stopping:
+            items = [await self._closed.get()]
+            while not self._closed.empty():
+                items.append(self._closed.get_nowait())
+            stopping = None in items
+            pending += [item for item in items if item is not None]
+            if not pending:
+                continue
+            try:
+                await asyncio.to_thread(self._save, pending)
+                pending = []
+            except Exception as e:
+                # Kept for the next write, the insert skips rows that made it
+                logger.error(f"Cannot save {len(pending)} closed candle pages: {e}")
+                if self._conn is not None:
+                    await asyncio.to_thread(self._conn.close)
+                    self._conn = None
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    async def backfill(self, symbols: Iterable[str]) -> None:
+        """Apply and save the candles of ``symbols`` after their last closed one."""
+        step = interval_ms(self.interval)
+
+        async def backfill_symbol(symbol: str, last_closed: int) -> None:
+            try:
+                candles = CandleFrame.concat(
+                    [
+                        page
+                        async for page in fetch_range(
+                            self.client, symbol, self.interval, from_ms(last_closed + step)
+                        )
+                    ]
+                )
+                if not len(candles):
+                    return
+                await self.apply(candles)
+                # The still-forming candle is left to the stream
+                closed = candles.slice_time(
+                    end=datetime.now(timezone.utc) - INTERVALS_TO_DELTA[self.interval]
+                )
+                if len(closed):
+                    self._closed.put_nowait(closed)
+                    self.last_closed[symbol] = max(
+                        self.last_closed.get(symbol, 0), int(closed.time[-1])
+                    )
+                logger.info(f"Backfilled {len(candles)} {symbol} candles")
+            except Exception as e:
+                logger.error(f"Cannot backfill {symbol}: {e}")
+
+        # The client's weight limiter paces the requests
+        await asyncio.gather(
+            *(
+                backfill_symbol(symbol, self.last_closed[symbol])
+                for symbol in list(symbols)
+                if symbol in self.last_closed
+            )
+        )
+
+    async def run(self, stop: asyncio.Event) -> None:
+        own_client = self.client is None
+        if own_client:
+            self.client = BinanceClient()
+        self._stop = stop
+        self._session = aiohttp.ClientSession()
+        writer = asyncio.create_task(self._writer())
+        try:
+            while not stop.is_set():
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.error(f"Cannot refresh open signals: {e}")
+                try:
+                    await asyncio.wait_for(stop.wait(), self.refresh_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for connection in self.connections:
+                await connection.close()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._closed.put_nowait(None)
+            await writer
+            await self._session.close()
+            if own_client:
+                await self.client.close()
+            logger.info(f"Tracker stopped, {self.settled} signals settled live")
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers, Ctrl+C still works
+            pass
+    await KlineTracker().run(stop)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Stopped by user.")
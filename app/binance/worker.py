@@ -0,0 +1,116 @@
+from app.binance.candles import load_open_signals
+from app.binance.client import BinanceClient
+from app.binance.planner import settle_batch
+from app.binance.search import default_horizon
+from app.config import (
+    BASE_INTERVAL,
+    INTERVALS_TO_DELTA,
+    SETTLEMENT_CONCURRENCY,
+    WORKER_BATCH_SIZE,
+    WORKER_POLL_SECONDS,
+)
+from datetime import timedelta
+from typing import Optional
+import argparse
+import asyncio
+import logging
+import signal
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def run_worker(
+    stop: asyncio.Event,
+    batch_size: int = WORKER_BATCH_SIZE,
+    poll_seconds: float = WORKER_POLL_SECONDS,
+    concurrency: int = SETTLEMENT_CONCURRENCY,
+    interval: str = BASE_INTERVAL,
+    search: bool = False,
+    horizon: Optional[timedelta] = None,
+) -> None:
+    """Settle open signals in batches until ``stop`` is set.
+
+    Every poll walks through all open signals by id, ``batch_size`` at a time,
+    fetching and storing their candles and writing close_time/result/pnl. A stop
+    request lets the current batch finish. With ``search`` closes are found
+    by a coarse-to-fine search and candles are not stored.
+    """
+    async with BinanceClient(connections=max(1, concurrency)) as client:
+        while not stop.is_set():
+            after_id = 0
+            while not stop.is_set():
+                batch = await asyncio.to_thread(
+                    load_open_signals, None, batch_size, after_id
+                )
+                if not batch:
+                    break
+                await settle_batch(
+                    batch,
+                    interval=interval,
+                    concurrency=concurrency,
+                    client=client,
+                    search=search,
+                    horizon=horizon,
+                )
+                after_id = batch[-1].id
+                if len(batch) < batch_size:
+                    break
+            if client.cache is not None:
+                logger.info(f"Kline cache: {client.cache.stats()}")
+            try:
+                await asyncio.wait_for(stop.wait(), poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+    logger.info("Settlement worker stopped")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Settle open trading signals")
+    parser.add_argument("--batch-size", type=int, default=WORKER_BATCH_SIZE)
+    parser.add_argument("--poll-seconds", type=float, default=WORKER_POLL_SECONDS)
+    parser.add_argument("--concurrency", type=int, default=SETTLEMENT_CONCURRENCY)
+    parser.add_argument(
+        "--interval", default=BASE_INTERVAL, choices=INTERVALS_TO_DELTA.keys()
+    )
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="find closes on 1d/1h candles first instead of storing every candle",
+    )
+    parser.add_argument(
+        "--horizon-days",
+        type=float,
+        default=None,
+        help="stop searching this many days after the signal",
+    )
+    args = parser.parse_args()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows event loops have no signal handlers, Ctrl+C still works
+            pass
+    await run_worker(
+        stop,
+        batch_size=args.batch_size,
+        poll_seconds=args.poll_seconds,
+        concurrency=args.concurrency,
+        interval=args.interval,
+        search=args.search,
+        horizon=(
+            timedelta(days=args.horizon_days)
+            if args.horizon_days
+            else default_horizon()
+        ),
+    )
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Stopped by user.")
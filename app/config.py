@@ -22,6 +22,21 @@ API_KEY_LLM = os.getenv("API_KEY_LLM")
 TZ = timezone(timedelta(hours=0))
 print(TZ)
 LIMIT = 50
+# Source channel entities and channel ids kept in memory, and for how many seconds
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "1024"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", str(6 * 3600)))
+# Channels backfilled at once and Telegram requests in flight across all of them
+BACKFILL_CHANNELS = int(os.getenv("BACKFILL_CHANNELS", "8"))
+BACKFILL_REQUESTS = int(os.getenv("BACKFILL_REQUESTS", "4"))
+# Messages per history request, Telegram returns at most 100
+BACKFILL_PAGE_SIZE = 100
+# Message id ranges of one channel read at the same time by a deep backfill
+BACKFILL_PARTITIONS = int(os.getenv("BACKFILL_PARTITIONS", "4"))
+# Live messages waiting for each ingestion stage, a full queue holds the handler back
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+# LLM calls running at once, each in its own thread
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", "2"))
+INGEST_STATS_SECONDS = float(os.getenv("INGEST_STATS_SECONDS", "60"))
 
 TG_API_ID: str = os.getenv("TG_API_ID")  # type: ignore
 TG_API_HASH: str = os.getenv("TG_API_HASH")  # type: ignore
@@ -32,16 +47,64 @@ TG_BASE_SESSION_NAME = os.getenv(
 TG_SESSION_SUFFIX = os.getenv("TG_SESSION_SUFFIX", "")
 TG_SESSION_NAME = f"{TG_BASE_SESSION_NAME}{TG_SESSION_SUFFIX}"
 
+# Binance settings
+BINANCE_API_URL = os.getenv("BINANCE_API_URL", "https://api.binance.com")
+# Request weight allowed per rate limit window, as named in X-MBX-USED-WEIGHT-*
+BINANCE_WEIGHT_LIMITS: Dict[str, int] = {
+    "1m": int(os.getenv("BINANCE_WEIGHT_LIMIT_1M", "6000")),
+}
+SETTLEMENT_CONCURRENCY = int(os.getenv("SETTLEMENT_CONCURRENCY", "8"))
+# Kline pages of one range downloaded at the same time
+FETCH_WINDOWS_IN_FLIGHT = int(os.getenv("FETCH_WINDOWS_IN_FLIGHT", "4"))
+BINANCE_WS_URL = os.getenv("BINANCE_WS_URL", "wss://stream.binance.com:9443")
+# Binance allows up to 1024 streams on one connection
+TRACKER_STREAMS_PER_CONNECTION = int(os.getenv("TRACKER_STREAMS_PER_CONNECTION", "200"))
+TRACKER_REFRESH_SECONDS = float(os.getenv("TRACKER_REFRESH_SECONDS", "30"))
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", "100"))
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "60"))
+# Pages waiting between two candle pipeline stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# Coarse intervals scanned before the fine ones when searching for a close
+SEARCH_LEVELS = ("1d", "1h")
+# Days after the signal time a search gives up, 0 searches up to now
+SEARCH_HORIZON_DAYS = float(os.getenv("SEARCH_HORIZON_DAYS", "0"))
+# Candlesticks drawn on a chart, longer ranges are merged into coarser buckets
+PLOT_MAX_POINTS = int(os.getenv("PLOT_MAX_POINTS", "3000"))
+# Candles around the signal time and every SL/TP hit kept at full resolution
+PLOT_KEEP_CANDLES = 60
+
 # Session dir path
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SESSIONS_DIR = os.path.join(BASE_DIR, "telegram/sessions")
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 TG_SESSION_PATH = os.path.join(SESSIONS_DIR, TG_SESSION_NAME)
 
-# Available
-# INTERVALS_TO_DELTA: Dict[str, timedelta] = {
-#     "1h": timedelta(hours=1),
-#     "30m": timedelta(minutes=30),
-#     "5m": timedelta(minutes=5),
-#     "1m": timedelta(minutes=1),
-# }
+# Parquet archive of old candles, partitioned by symbol/interval/month
+CANDLE_ARCHIVE_DIR = os.getenv(
+    "CANDLE_ARCHIVE_DIR", os.path.join(os.path.dirname(BASE_DIR), "data", "candles")
+)
+# Candles older than this many days are moved from Postgres to the archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+# On-disk cache of closed kline pages, a budget of 0 turns it off
+KLINE_CACHE_DIR = os.getenv(
+    "KLINE_CACHE_DIR", os.path.join(os.path.dirname(BASE_DIR), "data", "klines")
+)
+KLINE_CACHE_MAX_BYTES = int(os.getenv("KLINE_CACHE_MAX_BYTES", str(512 * 2**20)))
+
+# Binance kline intervals, candles are stored in BASE_INTERVAL and coarser
+# intervals are resampled from it
+BASE_INTERVAL = "1m"
+INTERVALS_TO_DELTA: Dict[str, timedelta] = {
+    "1m": timedelta(minutes=1),
+    "3m": timedelta(minutes=3),
+    "5m": timedelta(minutes=5),
+    "15m": timedelta(minutes=15),
+    "30m": timedelta(minutes=30),
+    "1h": timedelta(hours=1),
+    "2h": timedelta(hours=2),
+    "4h": timedelta(hours=4),
+    "6h": timedelta(hours=6),
+    "8h": timedelta(hours=8),
+    "12h": timedelta(hours=12),
+    "1d": timedelta(days=1),
+}
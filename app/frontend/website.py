@@ -1,25 +1,28 @@
-from typing import List
-from app.binance.candles import process_signal_row
-from app.binance.plotter import plot_candles_html
-from app.config import PASSWORD_SALT, DB_CONFIG
+from app.binance.candles import last_candle_time, load_candles
+from app.binance.plotter import build_figure
+from app.binance.settlement import settle_signal
+from app.config import PASSWORD_SALT, DB_CONFIG, INTERVALS_TO_DELTA
 from app.frontend.exceptions import *
+from datetime import datetime, timezone
 from decimal import Decimal
 from psycopg import OperationalError
 from streamlit import runtime
 from streamlit_extras.stylable_container import stylable_container
 from streamlit.web import cli as stcli
-import asyncio
+from typing import Optional, Tuple
 import hashlib
 import os
 import pandas as pd
+import plotly.graph_objects as go
 import psycopg
 import streamlit as st
-import streamlit.components.v1 as components
 import string
 import sys
-from app.types import Candle, Signal
+from app.types import Signal
 
 INTERVAL: str = "1m"
+# Charts kept by chart_figure, one per signal, interval and newest candle
+CHART_CACHE_ENTRIES = 32
 COLUMN_NAMES = [
     "ID",
     "Symbol",
@@ -407,22 +410,17 @@ def main():
         st.write(f"Selected signal: {selected_signal_id}")
 
         selected_signal_data = grep_signal_row(selected_signal_id)
-        # FIXME deleted multi interval
-        # selected_candle_interval = st.selectbox(
-        #     "Select the interval", INTERVALS_TO_DELTA.keys()
-        # )
-        # st.write(f"Selected interval: {selected_candle_interval}")
+        selected_candle_interval = st.selectbox(
+            "Select the interval", list(INTERVALS_TO_DELTA.keys())
+        )
         if selected_signal_data:
-            with st.spinner("Loading candles from Binance..."):
+            # Candles are downloaded by the settlement worker, the page only reads them
+            with st.spinner("Loading candles..."):
                 try:
-                    asyncio.run(
-                        process_signal_row(selected_signal_data, interval=INTERVAL)
-                    )
-                    st.success("Candles successfully loaded!")
                     show_plot(
                         signal_data=selected_signal_data,
                         signal_id=selected_signal_id,
-                        interval=INTERVAL,
+                        interval=selected_candle_interval,
                     )
                 except Exception as e:
                     st.error(f"Error while loading candles: {e}")
@@ -437,39 +435,62 @@ def main():
         authentication_page()
 
 
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def chart_figure(
+    signal_id: int, interval: str, last_candle: Optional[datetime], _signal: Signal
+) -> Tuple[Optional[go.Figure], int]:
+    """Figure of a signal's chart and its candle count.
+
+    Cached by signal, interval and newest stored candle, reruns that change
+    none of them reuse the figure without reading the candles again.
+    """
+    # Coarser intervals are resampled from the stored 1m candles
+    candles = load_candles(
+        _signal.symbol,
+        interval,
+        _signal.signal_time,
+        datetime.now(timezone.utc),
+    )
+    if not len(candles):
+        return None, 0
+    figure = build_figure(
+        candles=candles,
+        symbol=_signal.symbol,
+        signal_time=_signal.signal_time,
+        entry_prices=_signal.entry_prices,
+        stop_loss=_signal.stop_loss,
+        take_profits=_signal.take_profits,
+        signal_id=signal_id,
+        action=_signal.action if _signal.action in ("long", "short") else "long",
+        settlement=(
+            settle_signal(candles, _signal)
+            if _signal.action in ("long", "short")
+            else None
+        ),
+    )
+    return figure, len(candles)
+
+
 def show_plot(signal_data: Signal, signal_id: int, interval: str = INTERVAL):
     try:
-        candles = list()
-        with psycopg.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """SELECT * FROM candles c
-                    JOIN 
-                        trading_signals ts ON c.symbol = ts.symbol
-                    WHERE 
-                        ts.id = %s AND c.interval = %s AND c.time >= ts.signal_time
-                    ORDER BY 
-                        c.time""",
-                    (signal_id, interval),
-                )
-                rows = cur.fetchall()
-        candles: List[Candle] = [Candle.from_row(row) for row in rows]
-        st.write(len(candles))
-
-        plot_data = plot_candles_html(
-            candles=candles,
-            symbol=signal_data.symbol,
-            signal_time=signal_data.signal_time,
-            entry_prices=signal_data.entry_prices,
-            stop_loss=signal_data.stop_loss,
-            take_profits=signal_data.take_profits,
-            signal_id=signal_data.id,
+        figure, candle_count = chart_figure(
+            signal_data.id,
+            interval,
+            last_candle_time(signal_data.symbol, interval),
+            signal_data,
         )
-        if plot_data:
-            components.html(
-                plot_data,
-                height=800,
+        if not candle_count:
+            st.info(
+                "Candles for this signal are not loaded yet, "
+                "the settlement worker will fetch them shortly."
             )
+            return
+        st.write(candle_count)
+
+        # Only the figure JSON is sent, plotly.js comes once per browser
+        # session from the bundle Streamlit serves itself
+        if figure is not None:
+            st.plotly_chart(figure, use_container_width=True, theme=None)
         else:
             st.error("Failed to draw chart")
     except TypeError as e:
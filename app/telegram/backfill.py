@@ -0,0 +1,250 @@
+from .cache import channel_cache
+from .checkpoints import (
+    advance_partition,
+    create_checkpoint,
+    finish_deep,
+    load_checkpoint,
+    load_partitions,
+    raise_high,
+    split_ids,
+    start_deep,
+)
+from .tg_utils import parse_forward, save_batch_to_db
+from app.config import (
+    BACKFILL_CHANNELS,
+    BACKFILL_PAGE_SIZE,
+    BACKFILL_PARTITIONS,
+    BACKFILL_REQUESTS,
+    LIMIT,
+)
+from app.types import BackfillProgress
+from telethon.errors import FloodWaitError
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+ProgressCallback = Callable[[BackfillProgress], None]
+
+
+async def _request(
+    slots: asyncio.Semaphore, progress: BackfillProgress, call: Callable[[], Awaitable[T]]
+) -> T:
+    """Run a Telegram request in one of the shared slots.
+
+    A FloodWaitError pauses only the channel that got it: the slot is given
+    back, the channel sleeps for the time Telegram asked for and tries again.
+    """
+    while True:
+        async with slots:
+            try:
+                return await call()
+            except FloodWaitError as e:
+                wait = e.seconds
+        progress.flood_waits += 1
+        progress.waited += wait
+        logger.warning(f"{progress.channel}: flood wait, pausing for {wait}s")
+        await asyncio.sleep(wait)
+
+
+async def _read_ids(
+    client,
+    entity,
+    progress: BackfillProgress,
+    slots: asyncio.Semaphore,
+    cursor: int,
+    commit: Callable[[List[dict], int], int],
+    page_size: int = BACKFILL_PAGE_SIZE,
+    min_id: Optional[int] = None,
+    on_progress: Optional[ProgressCallback] = None,
+) -> None:
+    """Read a channel page by page from the message id ``cursor`` on.
+
+    Without ``min_id`` it reads newer messages, oldest first, until there are
+    none. With it, it reads older ones down to ``min_id``. ``commit`` runs in a
+    thread with the forwarded messages and the new cursor of every page. It
+    saves them and moves the checkpoint, while the next page is already being
+    read.
+    """
+    channel = progress.channel
+    committing: Optional[asyncio.Future] = None
+    try:
+        while True:
+            query = (
+                dict(offset_id=cursor, reverse=True)
+                if min_id is None
+                # offset_id and min_id are both exclusive
+                else dict(offset_id=cursor, min_id=min_id - 1)
+            )
+            page = await _request(
+                slots, progress, lambda: client.get_messages(entity, limit=page_size, **query)
+            )
+            if page:
+                cursor = page[-1].id
+            elif min_id is not None:
+                cursor = min_id
+
+            batch = []
+            for msg in page or []:
+                message = await _request(slots, progress, lambda: parse_forward(client, msg))
+                if message is not None:
+                    batch.append(message)
+            progress.fetched += len(page or [])
+            progress.kept += len(batch)
+            if committing is not None:
+                progress.saved += await committing
+            committing = asyncio.ensure_future(asyncio.to_thread(commit, batch, cursor))
+
+            logger.info(
+                f"{channel}: {progress.fetched} read, {progress.kept} forwarded, "
+                f"{progress.saved} saved"
+            )
+            if on_progress is not None:
+                on_progress(progress)
+            if not page:
+                break
+    finally:
+        if committing is not None:
+            progress.saved += await committing
+
+
+async def backfill_channel(
+    client,
+    progress: BackfillProgress,
+    channel_id: int,
+    slots: asyncio.Semaphore,
+    page_size: int = BACKFILL_PAGE_SIZE,
+    partitions: int = BACKFILL_PARTITIONS,
+    on_progress: Optional[ProgressCallback] = None,
+) -> BackfillProgress:
+    """Bring a channel's saved history up to date and ``progress.limit`` ids deep.
+
+    Messages newer than the high watermark are read first. The ids between
+    the low watermark and ``progress.limit`` below the newest message are then
+    split into ``partitions`` ranges read at the same time. Every page moves
+    the checkpoints, so after a crash the next run continues where this one
+    stopped instead of reading the newest messages again.
+    """
+    channel = progress.channel
+
+    # A failed save raises, the checkpoint is only moved past saved messages
+    def save(batch: List[dict]) -> int:
+        return save_batch_to_db(batch, channel) if batch else 0
+
+    def commit_newer(batch: List[dict], cursor: int) -> int:
+        saved = save(batch)
+        raise_high(channel_id, cursor)
+        return saved
+
+    try:
+        entity = await _request(slots, progress, lambda: channel_cache.get_entity(client, channel))
+        checkpoint = await asyncio.to_thread(load_checkpoint, channel_id)
+        if checkpoint is None:
+            newest = await _request(slots, progress, lambda: client.get_messages(entity, limit=1))
+            checkpoint = await asyncio.to_thread(
+                create_checkpoint, channel_id, newest[0].id if newest else 0
+            )
+        else:
+            await _read_ids(
+                client,
+                entity,
+                progress,
+                slots,
+                checkpoint.high_id,
+                commit_newer,
+                page_size,
+                on_progress=on_progress,
+            )
+            checkpoint = await asyncio.to_thread(load_checkpoint, channel_id)
+
+        if checkpoint.deep_low_id is None:
+            deep_low_id = max(checkpoint.high_id - progress.limit + 1, 1)
+            if deep_low_id < checkpoint.low_id:
+                ranges = split_ids(deep_low_id, checkpoint.low_id - 1, partitions)
+                await asyncio.to_thread(start_deep, channel_id, deep_low_id, ranges)
+        else:
+            logger.info(f"{channel}: resuming the backfill down to id {checkpoint.deep_low_id}")
+
+        async def read_partition(min_id: int, next_id: int) -> None:
+            def commit_older(batch: List[dict], cursor: int) -> int:
+                saved = save(batch)
+                advance_partition(channel_id, min_id, cursor)
+                return saved
+
+            await _read_ids(
+                client,
+                entity,
+                progress,
+                slots,
+                next_id,
+                commit_older,
+                page_size,
+                min_id,
+                on_progress,
+            )
+
+        pending = await asyncio.to_thread(load_partitions, channel_id)
+        # A failed partition leaves the others running to their end, its checkpoint
+        # is where the next run picks it up
+        results = await asyncio.gather(
+            *(read_partition(*partition) for partition in pending), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        await asyncio.to_thread(finish_deep, channel_id)
+        progress.done = True
+    except Exception as e:
+        progress.error = str(e)
+        logger.error(f"An error with backfilling channel {channel}: {e}")
+    if on_progress is not None:
+        on_progress(progress)
+    return progress
+
+
+async def backfill(
+    client,
+    channels: List[Tuple[str, int]],
+    limit: int = LIMIT,
+    channels_at_once: int = BACKFILL_CHANNELS,
+    requests: int = BACKFILL_REQUESTS,
+    page_size: int = BACKFILL_PAGE_SIZE,
+    partitions: int = BACKFILL_PARTITIONS,
+    on_progress: Optional[ProgressCallback] = None,
+) -> Dict[str, BackfillProgress]:
+    """Backfill several channels at the same time, see backfill_channel.
+
+    ``limit`` is how many message ids below the newest one each channel's saved
+    history should reach. Up to ``channels_at_once`` channels are read
+    together, and all of them share ``requests`` slots for Telegram requests.
+    ``channels`` are the (channel, channel_id) pairs of setup_channels.
+    """
+    channel_slots = asyncio.Semaphore(channels_at_once)
+    request_slots = asyncio.Semaphore(requests)
+    progress = {channel: BackfillProgress(channel, limit) for channel, _ in channels}
+
+    async def run(item: BackfillProgress, channel_id: int) -> None:
+        async with channel_slots:
+            await backfill_channel(
+                client, item, channel_id, request_slots, page_size, partitions, on_progress
+            )
+
+    # Telethon would sleep through short flood waits inside the request, holding
+    # a shared slot and stalling every channel, so all of them go to _request
+    flood_sleep_threshold = client.flood_sleep_threshold
+    client.flood_sleep_threshold = 0
+    try:
+        await asyncio.gather(
+            *(run(progress[channel], channel_id) for channel, channel_id in channels)
+        )
+    finally:
+        client.flood_sleep_threshold = flood_sleep_threshold
+    logger.info(
+        f"Backfilled {sum(p.done for p in progress.values())} of {len(progress)} channels: "
+        f"{sum(p.saved for p in progress.values())} messages saved, "
+        f"{sum(p.flood_waits for p in progress.values())} flood waits, "
+        f"channel cache {channel_cache.stats()}"
+    )
+    return progress
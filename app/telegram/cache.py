@@ -0,0 +1,130 @@
+from app.config import DB_CONFIG, ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL
+from cachetools import TTLCache
+from telethon.errors import ChannelPrivateError
+from telethon.tl.types import PeerChannel
+from typing import Any, Dict, Optional, Tuple
+import asyncio
+import logging
+import psycopg
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_username(username: str) -> str:
+    return username if username.startswith("@") else f"@{username}"
+
+
+class _Private:
+    """Cached instead of the entity of a channel that raised ChannelPrivateError.
+
+    The error itself is not kept, raising one instance again and again would
+    keep growing its traceback for as long as the entry lives.
+    """
+
+    __slots__ = ("request",)
+
+    def __init__(self, request):
+        self.request = request
+
+
+class ChannelCache:
+    """Telegram peer -> entity and channel username -> channels.id, both with a TTL.
+
+    Forwarded messages come from the same few dozen source channels, the cache
+    saves a get_entity request and a channels lookup for every repeat. Private
+    channels are remembered too, so they are not asked for again until the
+    entry expires.
+    """
+
+    def __init__(self, maxsize: int = ENTITY_CACHE_SIZE, ttl: float = ENTITY_CACHE_TTL):
+        self.entities: TTLCache = TTLCache(maxsize, ttl)
+        # username -> (channel id, title)
+        self.channels: TTLCache = TTLCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+        # channel_id and remember also run in threads, a TTLCache is not
+        # thread-safe and even a get drops expired entries
+        self._guard = threading.Lock()
+        # One get_entity in flight per peer, concurrent handlers wait for it
+        self._locks: Dict[Any, asyncio.Lock] = {}
+        # Tasks holding or waiting for each lock, it is dropped with the last one
+        self._users: Dict[Any, int] = {}
+
+    @staticmethod
+    def _peer_key(peer) -> Any:
+        return peer.channel_id if isinstance(peer, PeerChannel) else peer
+
+    async def get_entity(self, client, peer):
+        """client.get_entity through the cache, a ChannelPrivateError is cached as well."""
+        key = self._peer_key(peer)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                with self._guard:
+                    cached = self.entities.get(key)
+                    self._count(cached is not None)
+                if cached is None:
+                    try:
+                        cached = await client.get_entity(peer)
+                    except ChannelPrivateError as e:
+                        cached = _Private(e.request)
+                    with self._guard:
+                        self.entities[key] = cached
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+        if isinstance(cached, _Private):
+            raise ChannelPrivateError(cached.request)
+        return cached
+
+    def channel_id(self, username: str, title: Optional[str] = None) -> Optional[int]:
+        """Cached channels.id of ``username``, None when unknown or ``title`` changed."""
+        with self._guard:
+            cached: Optional[Tuple[int, str]] = self.channels.get(normalize_username(username))
+            hit = cached is not None and (title is None or title == cached[1])
+            self._count(hit)
+        return cached[0] if hit else None
+
+    def remember(self, username: str, channel_id: int, title: Optional[str] = None) -> None:
+        with self._guard:
+            self.channels[normalize_username(username)] = (channel_id, title or username)
+
+    def _count(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def warm(self, conn=None) -> int:
+        """Load every known channel from the channels table, returns how many."""
+        if conn is None:
+            with psycopg.connect(**DB_CONFIG) as conn:
+                return self.warm(conn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT id, username, title FROM channels")
+            rows = cur.fetchall()
+        for channel_id, username, title in rows:
+            self.remember(username, channel_id, title)
+        logger.info(f"Channel cache warmed with {len(rows)} channels")
+        return len(rows)
+
+    def stats(self) -> Dict[str, float]:
+        with self._guard:
+            hits, misses = self.hits, self.misses
+            entities, channels = len(self.entities), len(self.channels)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entities": entities,
+            "channels": channels,
+        }
+
+
+# Shared by the history parser and the live handlers
+channel_cache = ChannelCache()
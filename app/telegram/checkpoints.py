@@ -0,0 +1,171 @@
+from app.config import DB_CONFIG
+from app.types import MessageCheckpoint
+from typing import List, Optional, Tuple
+import logging
+import psycopg
+
+logger = logging.getLogger(__name__)
+
+# (lowest id, exclusive upper cursor) of a deep backfill partition still being read
+Partition = Tuple[int, int]
+
+_tables_ready = False
+
+
+def ensure_checkpoint_tables(conn) -> None:
+    global _tables_ready
+    if _tables_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_checkpoints (
+                channel_id INTEGER PRIMARY KEY,
+                low_id BIGINT NOT NULL,
+                high_id BIGINT NOT NULL,
+                deep_low_id BIGINT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_backfill_partitions (
+                channel_id INTEGER NOT NULL,
+                min_id BIGINT NOT NULL,
+                next_id BIGINT NOT NULL,
+                PRIMARY KEY (channel_id, min_id)
+            )
+            """
+        )
+    conn.commit()
+    _tables_ready = True
+
+
+def split_ids(low: int, high: int, parts: int) -> List[Tuple[int, int]]:
+    """Split the ids [low, high] into up to ``parts`` contiguous inclusive ranges."""
+    if high < low:
+        return []
+    size = -(-(high - low + 1) // max(parts, 1))
+    return [(start, min(start + size - 1, high)) for start in range(low, high + 1, size)]
+
+
+def load_checkpoint(channel_id: int, conn=None) -> Optional[MessageCheckpoint]:
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_checkpoint(channel_id, conn)
+    ensure_checkpoint_tables(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT channel_id, low_id, high_id, deep_low_id FROM message_checkpoints
+            WHERE channel_id = %s""",
+            (channel_id,),
+        )
+        row = cur.fetchone()
+    return MessageCheckpoint(*row) if row else None
+
+
+def create_checkpoint(channel_id: int, newest_id: int, conn=None) -> MessageCheckpoint:
+    """Start the watermarks of a channel just above ``newest_id``, nothing read yet."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return create_checkpoint(channel_id, newest_id, conn)
+    ensure_checkpoint_tables(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """INSERT INTO message_checkpoints (channel_id, low_id, high_id)
+            VALUES (%s, %s, %s) ON CONFLICT (channel_id) DO NOTHING""",
+            (channel_id, newest_id + 1, newest_id),
+        )
+    conn.commit()
+    return load_checkpoint(channel_id, conn)
+
+
+def raise_high(channel_id: int, high_id: int, conn=None) -> None:
+    """Record that every message up to ``high_id`` has been saved."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return raise_high(channel_id, high_id, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """UPDATE message_checkpoints
+            SET high_id = GREATEST(high_id, %s), updated_at = now()
+            WHERE channel_id = %s""",
+            (high_id, channel_id),
+        )
+    conn.commit()
+
+
+def start_deep(
+    channel_id: int, deep_low_id: int, ranges: List[Tuple[int, int]], conn=None
+) -> None:
+    """Plan a deep backfill down to ``deep_low_id`` as partitions of inclusive id ranges."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return start_deep(channel_id, deep_low_id, ranges, conn)
+    with conn.transaction():
+        with conn.cursor() as cur:
+            cur.execute(
+                """UPDATE message_checkpoints SET deep_low_id = %s, updated_at = now()
+                WHERE channel_id = %s""",
+                (deep_low_id, channel_id),
+            )
+            cur.executemany(
+                """INSERT INTO message_backfill_partitions (channel_id, min_id, next_id)
+                VALUES (%s, %s, %s) ON CONFLICT DO NOTHING""",
+                [(channel_id, low, high + 1) for low, high in ranges],
+            )
+
+
+def load_partitions(channel_id: int, conn=None) -> List[Partition]:
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return load_partitions(channel_id, conn)
+    ensure_checkpoint_tables(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """SELECT min_id, next_id FROM message_backfill_partitions
+            WHERE channel_id = %s ORDER BY min_id DESC""",
+            (channel_id,),
+        )
+        return [(row[0], row[1]) for row in cur.fetchall()]
+
+
+def advance_partition(channel_id: int, min_id: int, next_id: int, conn=None) -> None:
+    """Move a partition's cursor down to ``next_id``, dropping it once it reached ``min_id``."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return advance_partition(channel_id, min_id, next_id, conn)
+    with conn.cursor() as cur:
+        if next_id <= min_id:
+            cur.execute(
+                """DELETE FROM message_backfill_partitions
+                WHERE channel_id = %s AND min_id = %s""",
+                (channel_id, min_id),
+            )
+        else:
+            cur.execute(
+                """UPDATE message_backfill_partitions SET next_id = LEAST(next_id, %s)
+                WHERE channel_id = %s AND min_id = %s""",
+                (next_id, channel_id, min_id),
+            )
+    conn.commit()
+
+
+def finish_deep(channel_id: int, conn=None) -> bool:
+    """Lower the low watermark once every partition is read, True if it was."""
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return finish_deep(channel_id, conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            """UPDATE message_checkpoints
+            SET low_id = LEAST(low_id, deep_low_id), deep_low_id = NULL, updated_at = now()
+            WHERE channel_id = %s AND deep_low_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM message_backfill_partitions WHERE channel_id = %s
+            )""",
+            (channel_id, channel_id),
+        )
+        finished = cur.rowcount > 0
+    conn.commit()
+    return finished
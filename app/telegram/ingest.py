@@ -0,0 +1,139 @@
+from .analyze.msg_process import analyze_all_db_msg
+from .tg_utils import cached_channel_id, save_single_to_db
+from app.config import (
+    DB_CONFIG,
+    INGEST_PARSE_WORKERS,
+    INGEST_QUEUE_SIZE,
+    INGEST_STATS_SECONDS,
+)
+from app.types import StageStats
+from typing import Dict, List, Optional
+import asyncio
+import logging
+import psycopg
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class IngestPipeline:
+    """Live messages go through bounded queues to a persist worker and parse workers.
+
+    The Telegram handler only calls ``submit``, the source channel lookup,
+    the database insert and the LLM parsing run in threads of their own
+    stages, so neither the database nor a slow LLM response stops the client
+    from reading updates. When a queue is full ``submit`` waits, holding back
+    the handler instead of growing memory.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        parse_workers: int = INGEST_PARSE_WORKERS,
+        stats_seconds: float = INGEST_STATS_SECONDS,
+    ):
+        self.persist_queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.parse_queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.parse_workers = parse_workers
+        self.stats_seconds = stats_seconds
+        self.persisted = StageStats()
+        self.parsed = StageStats()
+        self._conn = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._persist_worker())]
+        self._tasks += [
+            asyncio.create_task(self._parse_worker()) for _ in range(self.parse_workers)
+        ]
+        if self.stats_seconds > 0:
+            self._tasks.append(asyncio.create_task(self._report()))
+
+    async def close(self) -> None:
+        """Finish the queued messages, then stop the workers."""
+        await self.persist_queue.join()
+        await self.parse_queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+        logger.info(f"Ingest pipeline stopped: {self.stats()}")
+
+    async def submit(self, message: dict, channel: str) -> None:
+        """Queue a message whose "source" is the (username, title) it was forwarded from."""
+        await self.persist_queue.put((message, channel, time.monotonic()))
+
+    def _save(self, message: dict, channel: str) -> Optional[int]:
+        # One connection for the whole stage, opened again after a failure
+        if self._conn is None or self._conn.closed:
+            self._conn = psycopg.connect(**DB_CONFIG)
+        message["channel_id"] = cached_channel_id(*message["source"], self._conn)
+        return save_single_to_db(message, channel, self._conn)
+
+    async def _persist_worker(self) -> None:
+        while True:
+            message, channel, queued_at = await self.persist_queue.get()
+            started = time.monotonic()
+            msg_id = None
+            ok = False
+            try:
+                msg_id = await asyncio.to_thread(self._save, message, channel)
+                ok = True
+            except Exception as e:
+                logger.error(f"An error with saving new message from channel {channel}: {e}")
+                if self._conn is not None:
+                    await asyncio.to_thread(self._conn.close)
+                    self._conn = None
+            self.persisted.record(started - queued_at, time.monotonic() - started, ok)
+            # Done only once handed on, so close() waiting for both queues misses nothing
+            try:
+                if msg_id is not None:
+                    row = (msg_id, message["channel_id"], message["text"], message["date"])
+                    await self.parse_queue.put((row, time.monotonic()))
+            finally:
+                self.persist_queue.task_done()
+
+    async def _parse_worker(self) -> None:
+        while True:
+            row, queued_at = await self.parse_queue.get()
+            started = time.monotonic()
+            ok = False
+            try:
+                await asyncio.to_thread(analyze_all_db_msg, [row])
+                ok = True
+            except Exception as e:
+                logger.error(f"An error with parsing message {row[0]}: {e}")
+            finally:
+                self.parsed.record(started - queued_at, time.monotonic() - started, ok)
+                self.parse_queue.task_done()
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_seconds)
+            logger.info(
+                f"Ingest queues: persist {self.persist_queue.qsize()}/{self.persist_queue.maxsize}, "
+                f"parse {self.parse_queue.qsize()}/{self.parse_queue.maxsize}; "
+                f"persisted {self.persisted.processed} "
+                f"(wait {self.persisted.avg_waited * 1000:.0f}ms, "
+                f"save {self.persisted.avg_busy * 1000:.0f}ms), "
+                f"parsed {self.parsed.processed} "
+                f"(wait {self.parsed.avg_waited:.1f}s, llm {self.parsed.avg_busy:.1f}s, "
+                f"max {self.parsed.max_busy:.1f}s)"
+            )
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "persist_queue": self.persist_queue.qsize(),
+            "parse_queue": self.parse_queue.qsize(),
+            "persisted": self.persisted.processed,
+            "persist_failed": self.persisted.failed,
+            "persist_wait_avg": self.persisted.avg_waited,
+            "persist_avg": self.persisted.avg_busy,
+            "parsed": self.parsed.processed,
+            "parse_failed": self.parsed.failed,
+            "parse_wait_avg": self.parsed.avg_waited,
+            "parse_avg": self.parsed.avg_busy,
+            "parse_max": self.parsed.max_busy,
+        }
@@ -1,19 +1,18 @@
 from .analyze.msg_process import (
-    get_last_msg,
     get_not_proccesed_msgs,
     analyze_all_db_msg,
 )
 from .auth_check import check_auth
+from .backfill import backfill
+from .cache import channel_cache
+from .ingest import IngestPipeline
 from .logging_config import setup_logging
 from .tg_utils import (
-    get_or_create_channel,
-    fetch_messages,
-    save_batch_to_db,
-    save_single_to_db,
+    cached_channel_id,
+    forward_source,
 )
 from app.config import TZ, LIMIT, DB_CONFIG, TG_SESSION_PATH
 from telethon import events
-from telethon.errors import ChannelPrivateError
 from telethon.tl.types import Channel, PeerChannel
 import asyncio
 import logging
@@ -29,8 +28,8 @@ async def setup_channels(client, conn, channels_input):
     channels_to_parse = []
     for channel in [c.strip() for c in channels_input.split(",") if c.strip()]:
         try:
-            entity = await client.get_entity(channel)
-            channel_id = get_or_create_channel(conn, channel, entity.title)
+            entity = await channel_cache.get_entity(client, channel)
+            channel_id = cached_channel_id(channel, entity.title, conn)
             channels_to_parse.append((channel, channel_id))
         except Exception as e:
             logger.error(f"Cannot add channel {channel}: {e}")
@@ -39,21 +38,25 @@ async def setup_channels(client, conn, channels_input):
 
 
 async def run_parser(client, conn, channels_to_parse, limit):
-    """Run the parser for historical messages."""
-    for channel, channel_id in channels_to_parse:
-        print(f"⏳ Parsing {limit} last messages from channel {channel}...")
-        messages = await fetch_messages(client, conn, channel, channel_id, limit)
-        if messages:
-            save_batch_to_db(messages, channel)
-        print(f"✅ Saved {len(messages)} last messages from channel {channel}")
+    """Run the parser for historical messages, several channels at a time."""
+    print(
+        f"⏳ Parsing {limit} last messages from channels "
+        f"{', '.join(channel for channel, _ in channels_to_parse)}..."
+    )
+    progress = await backfill(client, channels_to_parse, limit)
+    for item in progress.values():
+        if item.error:
+            print(f"❌ Channel {item.channel}: {item.error}")
+        else:
+            print(f"✅ Saved {item.saved} of {item.kept} last messages from channel {item.channel}")
 
 
-async def subscribe_to_channels(client, channels_to_parse):
-    """Subscribe to new messages from channels."""
+async def subscribe_to_channels(client, channels_to_parse, pipeline):
+    """Subscribe to new messages from channels, handing them to the ingest pipeline."""
     entities = []
     for channel, channel_id in channels_to_parse:
         try:
-            entity = await client.get_entity(channel)
+            entity = await channel_cache.get_entity(client, channel)
             entities.append((channel, entity, channel_id))
         except Exception as e:
             logger.error(f"An error with getting the entity of channel {channel}: {e}")
@@ -62,14 +65,14 @@ async def subscribe_to_channels(client, channels_to_parse):
     for channel, entity, channel_id in entities:
         client.add_event_handler(
             lambda event, ch=channel, ch_id=channel_id: handle_new_message(
-                event, ch, ch_id
+                event, ch, ch_id, pipeline
             ),
             events.NewMessage(chats=entity),
         )
 
 
-async def handle_new_message(event, channel, channel_id):
-    """Handle a new message event, processing only forwarded messages from other channels."""
+async def handle_new_message(event, channel, channel_id, pipeline):
+    """Queue forwarded messages from other channels, saving and parsing them is left to the pipeline."""
     if not event.message.message or not isinstance(event.chat, Channel):
         logger.debug(
             f"Skipped the message {event.message.id}: there is no text or not from channel."
@@ -82,8 +85,6 @@ async def handle_new_message(event, channel, channel_id):
         logger.debug(f"Skipped message {event.message.id}: is not forwarded from channel")
         return
 
-    author = None
-    original_channel_id = channel_id
     message_id = (
         event.message.fwd_from.channel_post
         if event.message.fwd_from.channel_post
@@ -96,50 +97,23 @@ async def handle_new_message(event, channel, channel_id):
     )
 
     try:
-        with psycopg.connect(**DB_CONFIG) as conn:
-            original_channel = await event.client.get_entity(
-                event.message.fwd_from.from_id
-            )
-            original_channel_id = get_or_create_channel(
-                conn,
-                original_channel.username or str(original_channel.id),
-                original_channel.title,
-            )
-            author = original_channel.title or str(original_channel.id)
-    except ChannelPrivateError:
-        with psycopg.connect(**DB_CONFIG) as conn:
-            original_channel_id = get_or_create_channel(
-                conn,
-                f"channel_{event.message.fwd_from.from_id.channel_id}",
-                f"Private Channel {event.message.fwd_from.from_id.channel_id}",
-            )
-            author = (
-                event.message.fwd_from.from_name
-                or event.message.post_author
-                or "Unknown"
-            )
+        # Only the Telegram part, the channels lookup is left to the pipeline's thread
+        username, title, author = await forward_source(event.client, event.message)
     except Exception as e:
         logger.error(
             f"An error with getting original channel for message {event.message.id}: {e}"
         )
-        author = (
-            event.message.fwd_from.from_name or event.message.post_author or "Unknown"
-        )
         return
 
     new_message = {
-        "channel_id": original_channel_id,
+        "source": (username, title),
         "text": event.message.message,
         "date": date,
         "author": author,
         "message_id": message_id,
     }
-    save_single_to_db(new_message, channel)
-    last_msg = get_last_msg()
-    if last_msg and isinstance(last_msg, (tuple, list)):
-        analyze_all_db_msg([last_msg])
-    else:
-        logger.warning(f"Cannot analyse last message: {last_msg}")
+    # Waits only while the pipeline is full, the LLM call never runs here
+    await pipeline.submit(new_message, channel)
 
 
 async def main():
@@ -169,6 +143,7 @@ async def main():
 
         with psycopg.connect(**DB_CONFIG) as conn:
             try:
+                channel_cache.warm(conn)
                 channels_to_parse = await setup_channels(client, conn, channels_input)
                 if not channels_to_parse:
                     print("No channels to parse.")
@@ -188,11 +163,16 @@ async def main():
                 else:
                     print("No data for analysis after parsing.")
 
-                await subscribe_to_channels(client, channels_to_parse)
-                print(
-                    f"Waiting for new messages in channels: {', '.join(c[0] for c in channels_to_parse)}..."
-                )
-                await client.run_until_disconnected()
+                pipeline = IngestPipeline()
+                pipeline.start()
+                try:
+                    await subscribe_to_channels(client, channels_to_parse, pipeline)
+                    print(
+                        f"Waiting for new messages in channels: {', '.join(c[0] for c in channels_to_parse)}..."
+                    )
+                    await client.run_until_disconnected()
+                finally:
+                    await pipeline.close()
             except Exception as e:
                 logger.error(f"Error: {e}")
                 print(f"Error: {e}")
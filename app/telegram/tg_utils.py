@@ -1,6 +1,9 @@
-from app.config import DB_CONFIG, TZ, LIMIT
-from telethon.errors import ChannelInvalidError, ChannelPrivateError
+from .cache import channel_cache
+from app.config import DB_CONFIG, TZ
+from telethon.errors import ChannelPrivateError, FloodWaitError
 from telethon.tl.types import PeerChannel
+from typing import Optional, Tuple
+import asyncio
 import logging
 import psycopg
 
@@ -39,92 +42,105 @@ def get_or_create_channel(conn, username, title=None):
             raise
 
 
-async def fetch_messages(
-    client, conn, channel_username: str, channel_id: int, limit: int = LIMIT
-) -> list:
-    """Fetch messages from a Telegram channel, processing only forwarded messages from other channels."""
-    try:
-        entity = await client.get_entity(channel_username)
-        messages = []
-        async for msg in client.iter_messages(entity, limit=limit):
-            if (
-                not msg.message
-                or "% profit" in msg.message.lower()
-                or "premium" in msg.message.lower()
-            ):
-                logger.debug(
-                    f"Skipped message {msg.id}: no text or there are '% profit'/'premium'"
-                )
-                continue
+def cached_channel_id(username, title=None, conn=None) -> int:
+    """get_or_create_channel through the shared cache, a hit needs no connection."""
+    channel_id = channel_cache.channel_id(username, title)
+    if channel_id is not None:
+        return channel_id
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return cached_channel_id(username, title, conn)
+    channel_id = get_or_create_channel(conn, username, title)
+    channel_cache.remember(username, channel_id, title)
+    return channel_id
 
-            # Пропускаем сообщения, которые не являются пересылками из каналов
-            if not msg.fwd_from or not isinstance(msg.fwd_from.from_id, PeerChannel):
-                logger.debug(f"Skipped message {msg.id}: is not forwarded from channel")
-                continue
 
-            author = None
-            original_channel_id = channel_id
-            message_id = (
-                msg.fwd_from.channel_post if msg.fwd_from.channel_post else msg.id
-            )
-            date = (
-                msg.fwd_from.date.astimezone(tz=TZ)
-                if msg.fwd_from.date
-                else msg.date.astimezone(tz=TZ)
-            )
+async def forward_source(client, msg) -> Tuple[str, str, str]:
+    """Username, title and author of the channel a message was forwarded from.
 
-            # Извлекаем данные оригинального канала
-            try:
-                original_channel = await client.get_entity(msg.fwd_from.from_id)
-                original_channel_id = get_or_create_channel(
-                    conn,
-                    original_channel.username or str(original_channel.id),
-                    original_channel.title,
-                )
-                author = original_channel.title or str(original_channel.id)
-            except ChannelPrivateError:
-                original_channel_id = get_or_create_channel(
-                    conn,
-                    f"channel_{msg.fwd_from.from_id.channel_id}",
-                    f"Private Channel {msg.fwd_from.from_id.channel_id}",
-                )
-                author = msg.fwd_from.from_name or msg.post_author or "Unknown"
-            except Exception as e:
-                logger.error(
-                    f"An error with getting original channel for message {msg.id}: {e}"
-                )
-                author = msg.fwd_from.from_name or msg.post_author or "Unknown"
-                continue  # Пропускаем сообщение, если канал недоступен
-
-            messages.append(
-                {
-                    "channel_id": original_channel_id,
-                    "text": msg.message,
-                    "date": date,
-                    "author": author,
-                    "message_id": message_id,
-                }
-            )
-            logger.debug(
-                f"Added message: channel_id={original_channel_id}, message_id={message_id}, author={author}"
-            )
-        return messages
+    A private channel gets placeholder names, other errors are raised.
+    """
+    peer = msg.fwd_from.from_id
+    try:
+        original_channel = await channel_cache.get_entity(client, peer)
     except ChannelPrivateError:
-        logger.error(f"The channel {channel_username} is private.")
-        print(f"The channel {channel_username} is private.")
-        return []
-    except ChannelInvalidError:
-        logger.error(f"The channel {channel_username} is not found.")
-        print(f"The channel {channel_username} is not found.")
-        return []
+        return (
+            f"channel_{peer.channel_id}",
+            f"Private Channel {peer.channel_id}",
+            msg.fwd_from.from_name or msg.post_author or "Unknown",
+        )
+    return (
+        original_channel.username or str(original_channel.id),
+        original_channel.title,
+        original_channel.title or str(original_channel.id),
+    )
+
+
+async def resolve_forward_source(client, msg, conn=None) -> Tuple[int, str]:
+    """Channel id and author of the channel a message was forwarded from.
+
+    The channels lookup of a cache miss runs in a thread, off the event loop.
+    """
+    username, title, author = await forward_source(client, msg)
+    channel_id = await asyncio.to_thread(cached_channel_id, username, title, conn)
+    return channel_id, author
+
+
+async def parse_forward(client, msg, conn=None) -> Optional[dict]:
+    """Row for the messages table of a message forwarded from another channel.
+
+    None for messages without text, '% profit'/'premium' posts, messages that
+    are not forwarded from a channel and sources that cannot be resolved.
+    """
+    if (
+        not msg.message
+        or "% profit" in msg.message.lower()
+        or "premium" in msg.message.lower()
+    ):
+        logger.debug(
+            f"Skipped message {msg.id}: no text or there are '% profit'/'premium'"
+        )
+        return None
+
+    # Пропускаем сообщения, которые не являются пересылками из каналов
+    if not msg.fwd_from or not isinstance(msg.fwd_from.from_id, PeerChannel):
+        logger.debug(f"Skipped message {msg.id}: is not forwarded from channel")
+        return None
+
+    message_id = msg.fwd_from.channel_post if msg.fwd_from.channel_post else msg.id
+    date = (
+        msg.fwd_from.date.astimezone(tz=TZ)
+        if msg.fwd_from.date
+        else msg.date.astimezone(tz=TZ)
+    )
+
+    # Извлекаем данные оригинального канала
+    try:
+        original_channel_id, author = await resolve_forward_source(client, msg, conn)
+    except FloodWaitError:
+        raise
     except Exception as e:
-        logger.error(f"An error with getting messages from {channel_username}: {e}")
-        print(f"An error with getting messages from {channel_username}: {e}")
-        return []
+        logger.error(f"An error with getting original channel for message {msg.id}: {e}")
+        return None  # Пропускаем сообщение, если канал недоступен
 
+    logger.debug(
+        f"Added message: channel_id={original_channel_id}, message_id={message_id}, author={author}"
+    )
+    return {
+        "channel_id": original_channel_id,
+        "text": msg.message,
+        "date": date,
+        "author": author,
+        "message_id": message_id,
+    }
 
-def save_batch_to_db(messages, channel):
-    """Save a batch of messages to the database."""
+
+def save_batch_to_db(messages, channel) -> int:
+    """Save a batch of messages to the database, returns how many were new.
+
+    Errors are raised after logging, a backfill only moves its checkpoint past
+    messages that were really saved.
+    """
     with psycopg.connect(**DB_CONFIG) as conn:
         with conn.cursor() as cur:
             try:
@@ -151,32 +167,43 @@ def save_batch_to_db(messages, channel):
                     )
                 else:
                     print(f"Saved {cur.rowcount} messages from channel {channel}")
+                return max(cur.rowcount, 0)
             except Exception as e:
                 print(f"AN error with saving to database (channel {channel}): {e}")
+                raise
 
 
-def save_single_to_db(msg, channel):
-    """Save a single message to the database."""
-    with psycopg.connect(**DB_CONFIG) as conn:
-        with conn.cursor() as cur:
-            try:
-                query = """
-                    INSERT INTO messages (channel_id, text, date, author, message_id)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (channel_id, message_id) DO NOTHING
-                """
-                data = (
-                    msg["channel_id"],
-                    msg["text"],
-                    msg["date"],
-                    msg["author"],
-                    msg["message_id"],
-                )
-                cur.execute(query, data)
-                conn.commit()
-                if cur.rowcount > 0:
-                    print(f"New message is saved (channel: {channel})")
-            except Exception as e:
-                print(
-                    f"An error with saving new message from channel {channel}: {e}"
-                )
+def save_single_to_db(msg, channel, conn=None) -> Optional[int]:
+    """Save a single message to the database, returns its id unless it was there already.
+
+    A failed insert is rolled back and raised, the caller counts it and may
+    reset the connection.
+    """
+    if conn is None:
+        with psycopg.connect(**DB_CONFIG) as conn:
+            return save_single_to_db(msg, channel, conn)
+    with conn.cursor() as cur:
+        try:
+            query = """
+                INSERT INTO messages (channel_id, text, date, author, message_id)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (channel_id, message_id) DO NOTHING
+                RETURNING id
+            """
+            data = (
+                msg["channel_id"],
+                msg["text"],
+                msg["date"],
+                msg["author"],
+                msg["message_id"],
+            )
+            cur.execute(query, data)
+            row = cur.fetchone()
+            conn.commit()
+            if row:
+                print(f"New message is saved (channel: {channel})")
+            return row[0] if row else None
+        except Exception as e:
+            conn.rollback()
+            print(f"An error with saving new message from channel {channel}: {e}")
+            raise
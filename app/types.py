@@ -1,6 +1,7 @@
-from typing import List, Optional, TypedDict
-from datetime import datetime
+from typing import Iterable, List, Literal, Optional, Sequence, TypedDict, Union
+from datetime import datetime, timezone
 from dataclasses import dataclass
+import numpy as np
 
 
 class Db_config(TypedDict):
@@ -71,3 +72,281 @@ class Candle:
             close=row[5],
             volume=row[6],
         )
+
+
+def to_ms(moment: Union[datetime, int]) -> int:
+    """Epoch milliseconds of a datetime, naive datetimes are taken as UTC."""
+    if isinstance(moment, datetime):
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return int(round(moment.timestamp() * 1000))
+    return int(moment)
+
+
+def from_ms(ms: int) -> datetime:
+    return datetime.fromtimestamp(int(ms) / 1000, tz=timezone.utc)
+
+
+@dataclass
+class CandleFrame:
+    """Columnar candles of one symbol: int64 epoch-ms open times, float64 OHLCV."""
+
+    symbol: str
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    @classmethod
+    def empty(cls, symbol: str) -> "CandleFrame":
+        return cls._from_block(symbol, np.empty((0, 6), dtype=np.float64))
+
+    @classmethod
+    def _from_block(cls, symbol: str, block: np.ndarray) -> "CandleFrame":
+        # Columns stay views into the block, no per-column copies
+        return cls(
+            symbol=symbol,
+            time=block[:, 0].astype(np.int64),
+            open=block[:, 1],
+            high=block[:, 2],
+            low=block[:, 3],
+            close=block[:, 4],
+            volume=block[:, 5],
+        )
+
+    @classmethod
+    def from_klines(cls, symbol: str, klines: Sequence[Sequence]) -> "CandleFrame":
+        """Build from Binance kline rows: [open_time, open, high, low, close, volume, ...]."""
+        if len(klines) == 0:
+            return cls.empty(symbol)
+        block = np.array([k[:6] for k in klines], dtype=np.float64)
+        return cls._from_block(symbol, block)
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[tuple], symbol: Optional[str] = None) -> "CandleFrame":
+        """Build from candles table rows: (time, symbol, open, high, low, close, volume, ...)."""
+        if not rows:
+            return cls.empty(symbol or "")
+        block = np.empty((len(rows), 6), dtype=np.float64)
+        block[:, 0] = [to_ms(row[0]) for row in rows]
+        block[:, 1:] = [row[2:7] for row in rows]
+        return cls._from_block(symbol or rows[0][1], block)
+
+    @classmethod
+    def from_candles(cls, candles: Sequence[Candle]) -> "CandleFrame":
+        if not candles:
+            return cls.empty("")
+        return cls.from_rows(
+            [(c.time, c.symbol, c.open, c.high, c.low, c.close, c.volume) for c in candles]
+        )
+
+    @classmethod
+    def concat(cls, frames: Iterable["CandleFrame"]) -> "CandleFrame":
+        frames = list(frames)
+        if not frames:
+            return cls.empty("")
+        if len(frames) == 1:
+            return frames[0]
+        return cls(
+            symbol=frames[0].symbol,
+            time=np.concatenate([f.time for f in frames]),
+            open=np.concatenate([f.open for f in frames]),
+            high=np.concatenate([f.high for f in frames]),
+            low=np.concatenate([f.low for f in frames]),
+            close=np.concatenate([f.close for f in frames]),
+            volume=np.concatenate([f.volume for f in frames]),
+        )
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __getitem__(self, index: slice) -> "CandleFrame":
+        return CandleFrame(
+            symbol=self.symbol,
+            time=self.time[index],
+            open=self.open[index],
+            high=self.high[index],
+            low=self.low[index],
+            close=self.close[index],
+            volume=self.volume[index],
+        )
+
+    def index_of(self, moment: Union[datetime, int]) -> int:
+        """Index of the first candle opened at or after ``moment``."""
+        return int(np.searchsorted(self.time, to_ms(moment), side="left"))
+
+    def slice_time(
+        self,
+        start: Optional[Union[datetime, int]] = None,
+        end: Optional[Union[datetime, int]] = None,
+    ) -> "CandleFrame":
+        """Zero-copy view of the candles opened in [start, end]."""
+        lo = 0 if start is None else self.index_of(start)
+        hi = (
+            len(self)
+            if end is None
+            else int(np.searchsorted(self.time, to_ms(end), side="right"))
+        )
+        return self[lo:hi]
+
+    def time_at(self, index: int) -> datetime:
+        return from_ms(self.time[index])
+
+    def datetimes(self) -> np.ndarray:
+        return self.time.astype("datetime64[ms]")
+
+    def to_candles(self) -> List[Candle]:
+        return [
+            Candle(
+                time=from_ms(t),
+                symbol=self.symbol,
+                open=o,
+                high=h,
+                low=l,
+                close=c,
+                volume=v,
+            )
+            for t, o, h, l, c, v in zip(
+                self.time.tolist(),
+                self.open.tolist(),
+                self.high.tolist(),
+                self.low.tolist(),
+                self.close.tolist(),
+                self.volume.tolist(),
+            )
+        ]
+
+
+@dataclass
+class Settlement:
+    """First SL hit and first hit of every TP level of one signal."""
+
+    sl_time: Optional[datetime]
+    tp_times: List[Optional[datetime]]
+    close_time: Optional[datetime]
+    result: Optional[Literal["success", "fail"]]
+    # Index of the closing candle in the settled frame
+    close_index: Optional[int] = None
+    # TP levels reached on or before the closing candle
+    tps_hit: int = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.result is not None
+
+
+@dataclass
+class SettlementStats:
+    signals: int = 0
+    failed: int = 0
+    candles: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def signals_per_sec(self) -> float:
+        return self.signals / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def candles_per_sec(self) -> float:
+        return self.candles / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass
+class BacktestResult:
+    """Per-signal backtest outcomes, one array element per signal.
+
+    Times are epoch milliseconds, -1 where the signal never got there. PnL is in
+    percent of the margin allotted to the signal, fees included.
+    """
+
+    signal_id: np.ndarray
+    channel_id: np.ndarray
+    entry_time: np.ndarray
+    exit_time: np.ndarray
+    # Share of the entry ladder filled, 0..1
+    filled: np.ndarray
+    tps_hit: np.ndarray
+    # "tp", "sl", "breakeven", "timeout", "open" or "not_filled"
+    outcome: np.ndarray
+    pnl: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.signal_id)
+
+
+@dataclass
+class ChannelStats:
+    channel_id: int
+    signals: int
+    trades: int
+    wins: int
+    total_pnl: float
+    max_drawdown: float
+    # Cumulative PnL after every trade, stamped with its exit time
+    equity_time: np.ndarray
+    equity: np.ndarray
+
+    @property
+    def win_rate(self) -> float:
+        return self.wins / self.trades if self.trades else 0.0
+
+
+@dataclass
+class BackfillProgress:
+    """How far the history backfill of one channel got."""
+
+    channel: str
+    limit: int
+    # Messages read from the channel and forwarded ones kept out of them
+    fetched: int = 0
+    kept: int = 0
+    saved: int = 0
+    flood_waits: int = 0
+    waited: float = 0.0
+    done: bool = False
+    error: Optional[str] = None
+
+
+@dataclass
+class MessageCheckpoint:
+    """Message ids of a channel already saved: every id in [low_id, high_id].
+
+    Before anything is read low_id is high_id + 1. ``deep_low_id`` is the
+    target of a deep backfill whose partitions are still being read.
+    """
+
+    channel_id: int
+    low_id: int
+    high_id: int
+    deep_low_id: Optional[int] = None
+
+
+@dataclass
+class StageStats:
+    """Throughput and latency of one ingestion stage."""
+
+    processed: int = 0
+    failed: int = 0
+    # Seconds items spent queued before the stage and inside it
+    waited: float = 0.0
+    busy: float = 0.0
+    max_waited: float = 0.0
+    max_busy: float = 0.0
+
+    def record(self, waited: float, busy: float, ok: bool = True) -> None:
+        self.processed += 1
+        self.failed += not ok
+        self.waited += waited
+        self.busy += busy
+        self.max_waited = max(self.max_waited, waited)
+        self.max_busy = max(self.max_busy, busy)
+
+    @property
+    def avg_waited(self) -> float:
+        return self.waited / self.processed if self.processed else 0.0
+
+    @property
+    def avg_busy(self) -> float:
+        return self.busy / self.processed if self.processed else 0.0
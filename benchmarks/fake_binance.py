@@ -0,0 +1,296 @@
+"""Local stand-in for the Binance klines endpoint and kline streams.
+
+Serves a deterministic random walk: the same symbol, seed and open time always
+give the same candle, whatever window it is requested in. The /stream
+WebSocket pushes the same candles as combined kline streams. Run it on its own
+and point BINANCE_API_URL and BINANCE_WS_URL at it to try the app without
+touching Binance. With --weight-limit the klines endpoint enforces a request
+weight budget per window like Binance: 429 with Retry-After once it is spent,
+418 for requests that do not wait that long.
+
+    python -m benchmarks.fake_binance --port 8900 --latency 0.05 --weight-limit 600
+    BINANCE_API_URL=http://127.0.0.1:8900 BINANCE_WS_URL=ws://127.0.0.1:8900
+"""
+
+from aiohttp import web
+from app.binance.client import KLINES_WEIGHT, USED_WEIGHT_HEADER
+from app.binance.resample import interval_ms
+from app.config import INTERVALS_TO_DELTA
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import math
+import numpy as np
+import time
+import zlib
+
+MINUTE_MS = 60_000
+DAY_MS = 86_400_000
+# First candle the stand-in knows about, 2017-01-01 UTC
+ORIGIN_MS = 1_483_228_800_000
+MAX_LIMIT = 1000
+
+
+class SyntheticMarket:
+    """Random-walk 1m candles per symbol, coarser intervals aggregated from them.
+
+    Every UTC day is generated from its own seed, day opens are chained through
+    the daily returns so prices stay continuous across days.
+    """
+
+    def __init__(self, seed: int = 0, volatility: float = 0.001, start_price: float = 100.0):
+        self.seed = seed
+        self.volatility = volatility
+        self.start_price = start_price
+        self._day_opens: Dict[str, List[float]] = {}
+        self._days: Dict[Tuple[str, int], np.ndarray] = {}
+
+    def _rng(self, symbol: str, day: int) -> np.random.Generator:
+        return np.random.default_rng([self.seed, zlib.crc32(symbol.encode()), day])
+
+    def _returns(self, rng: np.random.Generator) -> np.ndarray:
+        return rng.normal(0.0, self.volatility, 1440)
+
+    def day_open(self, symbol: str, day: int) -> float:
+        opens = self._day_opens.setdefault(symbol, [self.start_price])
+        while len(opens) <= day:
+            returns = self._returns(self._rng(symbol, len(opens) - 1))
+            opens.append(opens[-1] * float(np.exp(returns.sum())))
+        return opens[day]
+
+    def day(self, symbol: str, day: int) -> np.ndarray:
+        """(1440, 5) block of open, high, low, close, volume for one UTC day."""
+        key = (symbol, day)
+        if key not in self._days:
+            if len(self._days) > 64:
+                self._days.clear()
+            rng = self._rng(symbol, day)
+            close = self.day_open(symbol, day) * np.exp(np.cumsum(self._returns(rng)))
+            open_ = np.append(self.day_open(symbol, day), close[:-1])
+            wicks = np.abs(rng.normal(0.0, self.volatility / 2, (2, 1440)))
+            block = np.empty((1440, 5))
+            block[:, 0] = open_
+            block[:, 1] = np.maximum(open_, close) * (1 + wicks[0])
+            block[:, 2] = np.minimum(open_, close) * (1 - wicks[1])
+            block[:, 3] = close
+            block[:, 4] = np.exp(rng.normal(3.0, 1.0, 1440))
+            self._days[key] = block
+        return self._days[key]
+
+    def klines(
+        self, symbol: str, interval: str, start_ms: int, end_ms: int, limit: int
+    ) -> List[list]:
+        step = interval_ms(interval)
+        now_ms = int(time.time() * 1000)
+        first = max(-(-start_ms // step) * step, ORIGIN_MS)
+        last = min(end_ms, now_ms, first + step * (limit - 1))
+        if last < first:
+            return []
+        count = (last - first) // step + 1
+        per_candle = step // MINUTE_MS
+        first_minute = (first - ORIGIN_MS) // MINUTE_MS
+        days = range(first_minute // 1440, (first_minute + count * per_candle - 1) // 1440 + 1)
+        offset = first_minute - days[0] * 1440
+        minutes = np.concatenate([self.day(symbol, day) for day in days])
+        grouped = minutes[offset : offset + count * per_candle].reshape(count, per_candle, 5)
+        open_times = first + np.arange(count, dtype=np.int64) * step
+        return [
+            [t, f"{o:.8f}", f"{h:.8f}", f"{l:.8f}", f"{c:.8f}", f"{v:.8f}", t + step - 1]
+            for t, o, h, l, c, v in zip(
+                open_times.tolist(),
+                grouped[:, 0, 0].tolist(),
+                grouped[:, :, 1].max(axis=1).tolist(),
+                grouped[:, :, 2].min(axis=1).tolist(),
+                grouped[:, -1, 3].tolist(),
+                grouped[:, :, 4].sum(axis=1).tolist(),
+            )
+        ]
+
+
+def kline_event(market: SyntheticMarket, stream: str, open_ms: int, closed: bool) -> dict:
+    """Combined stream payload of the candle opened at ``open_ms``, as Binance sends it."""
+    symbol, interval = stream.split("@kline_")
+    symbol = symbol.upper()
+    t, o, h, l, c, v, close_ms = market.klines(symbol, interval, open_ms, open_ms, 1)[0]
+    return {
+        "stream": stream,
+        "data": {
+            "e": "kline",
+            "E": int(time.time() * 1000),
+            "s": symbol,
+            "k": {
+                "t": t,
+                "T": close_ms,
+                "s": symbol,
+                "i": interval,
+                "o": o,
+                "c": c,
+                "h": h,
+                "l": l,
+                "v": v,
+                "x": closed,
+            },
+        },
+    }
+
+
+def create_app(
+    market: SyntheticMarket,
+    latency: float = 0.0,
+    tick: float = 1.0,
+    weight_limit: Optional[int] = None,
+    weight_window: int = 60,
+) -> web.Application:
+    """aiohttp app answering /api/v3/klines after ``latency`` seconds.
+
+    With ``weight_limit`` every ``weight_window`` seconds of the clock allow
+    that much request weight. The request that goes over it gets 429 with
+    Retry-After up to the next window, requests during that wait get 418.
+    ``rate_limited`` and ``banned`` count both answers.
+
+    /stream accepts SUBSCRIBE/UNSUBSCRIBE of ``<symbol>@kline_<interval>``
+    streams and sends the forming candle of each every ``tick`` seconds, the
+    previous one once more as closed when a new candle opens.
+    """
+    app = web.Application()
+    app["requests"] = 0
+    app["ws_messages"] = 0
+    app["rate_limited"] = 0
+    app["banned"] = 0
+    used: Dict[str, float] = {"window": 0, "weight": 0, "blocked_until": 0.0}
+    if weight_window % 60 == 0:
+        weight_header = f"{USED_WEIGHT_HEADER}{weight_window // 60}M"
+    else:
+        weight_header = f"{USED_WEIGHT_HEADER}{weight_window}S"
+
+    async def klines(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        query = request.query
+        interval = query.get("interval", "")
+        if interval not in INTERVALS_TO_DELTA or "symbol" not in query:
+            return web.json_response({"code": -1120, "msg": "Invalid interval."}, status=400)
+        now = time.time()
+        window = int(now // weight_window)
+        if used["window"] != window:
+            used.update(window=window, weight=0)
+        if weight_limit is not None and now < used["blocked_until"]:
+            app["banned"] += 1
+            return web.json_response(
+                {"code": -1003, "msg": "Way too much request weight used; IP banned."},
+                status=418,
+                headers={"Retry-After": str(math.ceil(used["blocked_until"] - now))},
+            )
+        used["weight"] += KLINES_WEIGHT
+        headers = {weight_header: str(used["weight"])}
+        if weight_limit is not None and used["weight"] > weight_limit:
+            app["rate_limited"] += 1
+            used["blocked_until"] = (window + 1) * weight_window
+            headers["Retry-After"] = str(math.ceil(used["blocked_until"] - now))
+            return web.json_response(
+                {"code": -1003, "msg": "Too much request weight used."},
+                status=429,
+                headers=headers,
+            )
+        limit = min(int(query.get("limit", 500)), MAX_LIMIT)
+        rows = market.klines(
+            query["symbol"],
+            interval,
+            int(query.get("startTime", ORIGIN_MS)),
+            int(query.get("endTime", 2**62)),
+            limit,
+        )
+        return web.json_response(rows, headers=headers)
+
+    async def stream(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        streams: Set[str] = set()
+
+        async def push() -> None:
+            last_open: Dict[str, int] = {}
+            while True:
+                await asyncio.sleep(tick)
+                now_ms = int(time.time() * 1000)
+                for name in sorted(streams):
+                    step = interval_ms(name.split("@kline_")[1])
+                    open_ms = now_ms // step * step
+                    previous = last_open.get(name)
+                    if previous is not None and previous < open_ms:
+                        await ws.send_json(kline_event(market, name, previous, True))
+                        app["ws_messages"] += 1
+                    last_open[name] = open_ms
+                    await ws.send_json(kline_event(market, name, open_ms, False))
+                    app["ws_messages"] += 1
+
+        pusher = asyncio.create_task(push())
+        try:
+            async for msg in ws:
+                if msg.type != web.WSMsgType.TEXT:
+                    continue
+                request_data = msg.json()
+                params = set(request_data.get("params", []))
+                if request_data.get("method") == "SUBSCRIBE":
+                    streams |= params
+                elif request_data.get("method") == "UNSUBSCRIBE":
+                    streams -= params
+                await ws.send_json({"result": None, "id": request_data.get("id")})
+        finally:
+            pusher.cancel()
+        return ws
+
+    app.router.add_get("/api/v3/klines", klines)
+    app.router.add_get("/stream", stream)
+    return app
+
+
+@asynccontextmanager
+async def serve(
+    market: SyntheticMarket,
+    latency: float = 0.0,
+    host: str = "127.0.0.1",
+    port: int = 0,
+    tick: float = 1.0,
+    weight_limit: Optional[int] = None,
+    weight_window: int = 60,
+) -> AsyncIterator[Tuple[str, web.Application]]:
+    """Run the stand-in in the current event loop and yield its base URL and app."""
+    app = create_app(market, latency, tick, weight_limit, weight_window)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    try:
+        yield f"http://{host}:{port}", app
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic Binance klines locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tick", type=float, default=1.0, help="seconds between kline updates")
+    parser.add_argument("--weight-limit", type=int, help="request weight per window")
+    parser.add_argument("--weight-window", type=int, default=60, help="seconds")
+    args = parser.parse_args()
+    web.run_app(
+        create_app(
+            SyntheticMarket(args.seed),
+            args.latency,
+            args.tick,
+            args.weight_limit,
+            args.weight_window,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
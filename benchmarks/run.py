@@ -0,0 +1,244 @@
+"""Benchmark the fetch -> save -> settle -> plot path of one signal.
+
+Every size runs in a fresh process against the synthetic klines server, so the
+reported peak RSS belongs to that size alone. With ``--db`` candles go through
+fetch_candles_until_close and save_candles into the configured Postgres under a
+throwaway symbol, otherwise the fetch stage streams pages with fetch_range and
+the save stage is skipped. With ``--cache`` the range is fetched a second time
+through a fresh kline cache to measure warm reads.
+
+    python -m benchmarks.run --sizes 1d 1mo 1y --latency 0.02 --output bench.json
+"""
+
+from aiohttp import web
+from app.binance.cache import KlineCache
+from app.binance.candles import fetch_candles_until_close, fetch_range, save_candles
+from app.binance.client import BinanceClient
+from app.binance.plotter import find_crossings, plot_candles_html
+from app.binance.settlement import settle
+from app.config import DB_CONFIG
+from app.types import CandleFrame
+from benchmarks.fake_binance import SyntheticMarket, create_app
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import psycopg
+import socket
+import sys
+import tempfile
+import time
+
+SIZES: Dict[str, timedelta] = {
+    "1d": timedelta(days=1),
+    "1mo": timedelta(days=30),
+    "1y": timedelta(days=365),
+}
+# Never listed on Binance, the --db run deletes its rows afterwards
+BENCH_SYMBOL = "BENCHMARKUSDT"
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@contextmanager
+def stage(report: dict, name: str, client: Optional[BinanceClient] = None) -> Iterator[dict]:
+    """Record wall time, requests issued and the process peak RSS after the stage."""
+    requests = client.requests if client is not None else 0
+    started = time.perf_counter()
+    extra: dict = {}
+    yield extra
+    report[name] = {
+        "seconds": round(time.perf_counter() - started, 4),
+        "requests": client.requests - requests if client is not None else 0,
+        "peak_rss_mb": peak_rss_mb(),
+        **extra,
+    }
+
+
+def _serve_forever(port: int, latency: float, seed: int) -> None:
+    web.run_app(
+        create_app(SyntheticMarket(seed), latency),
+        host="127.0.0.1",
+        port=port,
+        print=None,
+        access_log=None,
+    )
+
+
+@contextmanager
+def server_process(latency: float, seed: int = 0) -> Iterator[str]:
+    """Run the synthetic klines server in its own process and yield its URL.
+
+    Answering requests costs CPU too, keeping it out of the measured process
+    leaves only the client side in the numbers.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.get_context("spawn").Process(
+        target=_serve_forever, args=(port, latency, seed), daemon=True
+    )
+    process.start()
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            break
+        except OSError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError("Synthetic klines server did not start")
+            time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.join()
+
+
+def _cleanup(symbol: str) -> None:
+    with psycopg.connect(**DB_CONFIG) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM candles WHERE symbol = %s", (symbol,))
+            cur.execute("DELETE FROM candle_ranges WHERE symbol = %s", (symbol,))
+
+
+async def fetch_all(client: BinanceClient, start: datetime, end: datetime) -> CandleFrame:
+    return CandleFrame.concat(
+        [page async for page in fetch_range(client, BENCH_SYMBOL, "1m", start, end)]
+    )
+
+
+async def bench_size(size: str, base_url: str, use_db: bool, use_cache: bool) -> dict:
+    step = timedelta(minutes=1)
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0) - timedelta(hours=1)
+    start = end - SIZES[size] + step
+    report: dict = {"size": size, "stages": {}}
+    stages = report["stages"]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = KlineCache(cache_dir, max_bytes=2**32) if use_cache else None
+        async with BinanceClient(base_url=base_url, cache=cache, use_cache=use_cache) as client:
+            with stage(stages, "fetch", client) as extra:
+                if use_db:
+                    # Unreachable levels make it walk the whole range
+                    candles, _, _ = await fetch_candles_until_close(
+                        BENCH_SYMBOL, start, "1m", 0.0, [float("inf")], client=client, end=end
+                    )
+                else:
+                    candles = await fetch_all(client, start, end)
+                extra["candles"] = len(candles)
+            if cache is not None:
+                with stage(stages, "fetch_cached", client) as extra:
+                    await fetch_all(client, start, end)
+                    extra.update(cache.stats())
+    report["candles"] = len(candles)
+
+    try:
+        if use_db:
+            with stage(stages, "save") as extra:
+                extra["inserted"] = save_candles(candles, "1m")
+
+        entry = float(candles.open[0])
+        stop_loss = entry * 0.97
+        take_profits = [entry * 1.01, entry * 1.02, entry * 1.03]
+        with stage(stages, "settle") as extra:
+            extra["result"] = settle(candles, "long", stop_loss, take_profits, start).result
+
+        with stage(stages, "find_crossings"):
+            find_crossings(candles, start, stop_loss, take_profits)
+
+        with stage(stages, "plot") as extra:
+            html = plot_candles_html(
+                candles, BENCH_SYMBOL, start, [entry], stop_loss, take_profits, 0
+            )
+            extra["html_bytes"] = len(html)
+    finally:
+        if use_db:
+            _cleanup(BENCH_SYMBOL)
+
+    report["seconds"] = round(sum(s["seconds"] for s in stages.values()), 4)
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def _bench_size(size: str, base_url: str, use_db: bool, use_cache: bool) -> dict:
+    return asyncio.run(bench_size(size, base_url, use_db, use_cache))
+
+
+def compare(results: list, baseline: dict) -> None:
+    before = {r["size"]: r for r in baseline.get("results", [])}
+    for result in results:
+        old = before.get(result["size"])
+        if old is None:
+            continue
+        for name, now in result["stages"].items():
+            then = old["stages"].get(name)
+            if then and then["seconds"]:
+                print(
+                    f"{result['size']:>4} {name:<15} {then['seconds']:>9.3f}s -> "
+                    f"{now['seconds']:>9.3f}s ({now['seconds'] / then['seconds']:.2f}x)"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the candle pipeline")
+    parser.add_argument("--sizes", nargs="*", default=list(SIZES), choices=SIZES.keys())
+    parser.add_argument("--latency", type=float, default=0.0, help="server seconds per request")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", action="store_true", help="go through the configured Postgres")
+    parser.add_argument("--cache", action="store_true", help="also measure cached fetches")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    results = []
+    with server_process(args.latency, args.seed) as base_url:
+        for size in args.sizes:
+            # A fresh process per size keeps peak RSS comparable between sizes
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(_bench_size, size, base_url, args.db, args.cache).result()
+            results.append(result)
+            stages = ", ".join(f"{name} {s['seconds']:.3f}s" for name, s in result["stages"].items())
+            print(
+                f"{size:>4}: {result['candles']} candles, {stages}, "
+                f"{result['stages']['fetch']['requests']} requests, "
+                f"peak RSS {result['peak_rss_mb']} MB"
+            )
+
+    report = {
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "db": args.db,
+        "cache": args.cache,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()